@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# This Source Code Form is "Incompatible With Secondary Licenses", as
+# defined by the Mozilla Public License, v. 2.0.
+
+"""
+jb2bz-bench.py - repeatable throughput measurements for jb2bz.py
+
+    jb2bz-bench.py generate [OPTIONS] DIR
+        Write a synthetic JitterBug directory to DIR.
+
+    jb2bz-bench.py run [OPTIONS] DIR [-- JB2BZ-OPTIONS]
+        Import DIR with jb2bz.py (into a scratch SQLite database unless
+        JB2BZ-OPTIONS say otherwise) and append the measurements to a
+        results file.
+
+    jb2bz-bench.py compare [OPTIONS]
+        Compare the latest result with an earlier one and fail if it
+        regressed.
+
+Run any of them with -h for their options.
+"""
+
+import sys, os, time, json, random, base64, getopt, subprocess, tempfile
+import shutil, platform, math
+
+here = os.path.dirname(os.path.abspath(__file__))
+importer = os.path.join(here, "jb2bz.py")
+
+# Written into every generated directory; jb2bz.py ignores it.
+manifest_name = "corpus.json"
+
+words = ("the crash happens when saving a file with a long name after the "
+         "upgrade please attach logs core dump reproduced on build server "
+         "fixed in next release workaround restart daemon config option "
+         "segfault timeout memory leak patch review").split()
+
+def _text(rnd, n):
+    return " ".join(rnd.choice(words) for i in xrange(n))
+
+def _poisson(rnd, mean):
+    """A Poisson distributed count (Knuth's method; fine for small means)."""
+    if mean <= 0:
+        return 0
+    limit = math.exp(-mean)
+    k = 0
+    p = rnd.random()
+    while p > limit:
+        k = k + 1
+        p = p * rnd.random()
+    return k
+
+def _date(when):
+    return time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime(when))
+
+def _message(rnd, when, subject, attachments):
+    headers = ["From: user%d@example.com" % rnd.randint(1, 500),
+               "Date: %s" % _date(when)]
+    if subject is not None:
+        headers.append("Subject: %s" % subject)
+    body = "%s\n" % _text(rnd, rnd.randint(20, 400))
+    if not attachments:
+        return "\n".join(headers) + "\n\n" + body
+
+    boundary = "==bench%d==" % rnd.randint(0, 1 << 30)
+    headers.append("MIME-Version: 1.0")
+    headers.append('Content-Type: multipart/mixed; boundary="%s"' % boundary)
+    parts = ["Content-Type: text/plain\n\n" + body]
+    for i, size in enumerate(attachments):
+        if rnd.random() < 0.5:
+            # Logs and patches: text that compresses the way real ones do.
+            data = _text(rnd, size // 6 + 1)[:size]
+            name, ctype = "log%d.txt" % i, "text/plain"
+        else:
+            data = os.urandom(size)
+            name, ctype = "core%d.bin" % i, "application/octet-stream"
+        parts.append("Content-Type: %s\n"
+                     "Content-Transfer-Encoding: base64\n"
+                     'Content-Disposition: attachment; filename="%s"\n\n%s'
+                     % (ctype, name, base64.encodestring(data)))
+    return ("\n".join(headers) + "\n\n" +
+            "".join("--%s\n%s\n" % (boundary, part) for part in parts) +
+            "--%s--\n" % boundary)
+
+def _attachment_sizes(rnd, settings):
+    """Sizes of the attachments of one message; usually none."""
+    if rnd.random() >= settings['multipart']:
+        return []
+    count = max(1, _poisson(rnd, settings['attachments']))
+    return [ min(settings['attachment_max'],
+                 int(rnd.lognormvariate(settings['attachment_mu'],
+                                        settings['attachment_sigma'])))
+             for i in xrange(count) ]
+
+def generate(directory, settings):
+    """Write a synthetic JitterBug directory according to settings."""
+    rnd = random.Random(settings['seed'])
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    start = time.mktime((1998, 1, 1, 0, 0, 0, 0, 0, 0))
+    total_bytes = 0
+    for number in xrange(1, settings['bugs'] + 1):
+        when = start + number * 3600
+        files = []
+        files.append(("%d" % number,
+                      _message(rnd, when, "Bench bug %d: %s" % (number, _text(rnd, 6)),
+                               _attachment_sizes(rnd, settings))))
+        for kind, mean in (("reply", settings['replies']),
+                           ("followup", settings['followups'])):
+            for i in xrange(_poisson(rnd, mean)):
+                when = when + rnd.randint(60, 86400)
+                files.append(("%d.%s.%d" % (number, kind, i + 1),
+                              _message(rnd, when, None,
+                                       _attachment_sizes(rnd, settings))))
+        if rnd.random() < settings['notes']:
+            files.append(("%d.notes" % number, _text(rnd, rnd.randint(5, 200)) + "\n"))
+
+        for name, contents in files:
+            path = os.path.join(directory, name)
+            f = open(path, "w")
+            f.write(contents)
+            f.close()
+            os.utime(path, (when, when))
+            total_bytes = total_bytes + len(contents)
+
+    manifest = dict(settings)
+    manifest['bytes'] = total_bytes
+    f = open(os.path.join(directory, manifest_name), "w")
+    json.dump(manifest, f, indent=2, sort_keys=True)
+    f.close()
+    return manifest
+
+def run(directory, label, importer_args):
+    """Import directory once; returns the measurements."""
+    scratch = tempfile.mkdtemp(prefix="jb2bz-bench.")
+    try:
+        stats_file = os.path.join(scratch, "stats.json")
+        args = [sys.executable, importer, "--stats-file=" + stats_file]
+        if not [a for a in importer_args
+                if a.startswith(("--db-driver", "--export"))]:
+            args = args + ["--db-driver=sqlite",
+                           "--db-name=" + os.path.join(scratch, "bugs.db")]
+        args = args + importer_args + ["Bench"]
+
+        devnull = open(os.devnull, "w")
+        started = time.time()
+        child = subprocess.Popen(args, cwd=directory, stdout=devnull)
+        # wait4() rather than wait(): its rusage is this child's alone.
+        pid, status, usage = os.wait4(child.pid, 0)
+        elapsed = time.time() - started
+        devnull.close()
+        if status != 0:
+            raise RuntimeError("%s failed with status %d" % (" ".join(args), status))
+
+        f = open(stats_file)
+        stats = json.load(f)
+        f.close()
+    finally:
+        shutil.rmtree(scratch, True)
+
+    corpus = {}
+    manifest = os.path.join(directory, manifest_name)
+    if os.path.exists(manifest):
+        f = open(manifest)
+        corpus = json.load(f)
+        f.close()
+
+    bugs = max(stats['bugs'], 1)
+    result = {
+        'label': label,
+        'time': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        'host': platform.node(),
+        'directory': os.path.abspath(directory),
+        'corpus': corpus,
+        'args': importer_args,
+        'elapsed': elapsed,
+        'bugs': stats['bugs'],
+        'bugs_per_s': stats['bugs'] / elapsed,
+        'mb_per_s': stats['bytes_read'] / elapsed / (1024.0 * 1024.0),
+        'peak_rss_kb': usage.ru_maxrss,
+        'statements_per_bug': stats['statements'] / float(bugs),
+        'importer': stats,
+    }
+    return result
+
+def load_results(path):
+    results = []
+    if os.path.exists(path):
+        f = open(path)
+        for line in f:
+            if line.strip():
+                results.append(json.loads(line))
+        f.close()
+    return results
+
+def report(result):
+    print "%-20s %8d bugs %8.1f bugs/s %7.2f MB/s %8d KB peak RSS %6.2f stmts/bug" \
+          % (result['label'], result['bugs'], result['bugs_per_s'],
+             result['mb_per_s'], result['peak_rss_kb'], result['statements_per_bug'])
+
+def compare(results, baseline_label, threshold):
+    """Compare the last result with the baseline; returns the regressions."""
+    current = results[-1]
+    candidates = [ r for r in results[:-1]
+                   if r['corpus'] == current['corpus']
+                   and (baseline_label is None or r['label'] == baseline_label) ]
+    if not candidates:
+        print "No earlier result to compare %s with." % current['label']
+        return []
+    baseline = candidates[-1]
+    report(baseline)
+    report(current)
+
+    regressions = []
+    for key, higher_is_better in (('bugs_per_s', True), ('mb_per_s', True),
+                                  ('peak_rss_kb', False),
+                                  ('statements_per_bug', False)):
+        before, after = float(baseline[key]), float(current[key])
+        if before == 0:
+            continue
+        change = (after - before) / before
+        if not higher_is_better:
+            change = -change
+        if change < -threshold:
+            regressions.append("%s: %.2f -> %.2f (%+.1f%%)"
+                               % (key, before, after, change * 100))
+    return regressions
+
+def usage():
+    print __doc__
+    print """generate options:
+  --bugs=N                Number of bugs (default 1000).
+  --replies=MEAN          Average replies per bug (default 2).
+  --followups=MEAN        Average followups per bug (default 0.5).
+  --notes=RATIO           Share of bugs with a .notes file (default 0.3).
+  --multipart=RATIO       Share of messages with attachments (default 0.1).
+  --attachments=MEAN      Average attachments per multipart message (default 1).
+  --attachment-median=KB  Median attachment size (default 16).
+  --attachment-sigma=S    Spread of the log-normal size distribution (default 1.5).
+  --attachment-max=KB     Largest attachment (default 65536).
+  --seed=N                Random seed (default 1).
+
+run options:
+  --label=NAME            Name of this run in the results (default: "run").
+  --repeat=N              Import N times and keep the fastest (default 1).
+  --results=FILE          JSON lines file results are added to
+                          (default jb2bz-bench.jsonl).
+
+compare options:
+  --results=FILE          As for run.
+  --baseline=NAME         Compare with the last run labelled NAME rather
+                          than the last run on the same corpus.
+  --threshold=PERCENT     Allowed slowdown before failing (default 10).
+"""
+    sys.exit(1)
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ("generate", "run", "compare"):
+        usage()
+    command = sys.argv[1]
+    argv = sys.argv[2:]
+    importer_args = []
+    if "--" in argv:
+        importer_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    try:
+        opts, args = getopt.getopt(argv, "h",
+            ["bugs=", "replies=", "followups=", "notes=", "multipart=",
+             "attachments=", "attachment-median=", "attachment-sigma=",
+             "attachment-max=", "seed=", "label=", "repeat=", "results=",
+             "baseline=", "threshold="])
+    except getopt.GetoptError, e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+
+    settings = {'bugs': 1000, 'replies': 2.0, 'followups': 0.5, 'notes': 0.3,
+                'multipart': 0.1, 'attachments': 1.0, 'attachment_median': 16,
+                'attachment_sigma': 1.5, 'attachment_max': 65536, 'seed': 1}
+    label = "run"
+    repeat = 1
+    results_path = "jb2bz-bench.jsonl"
+    baseline = None
+    threshold = 10.0
+    for o, a in opts:
+        if o == '-h':
+            usage()
+        elif o in ('--bugs', '--seed'):
+            settings[o[2:]] = int(a)
+        elif o in ('--replies', '--followups', '--notes', '--multipart',
+                   '--attachments', '--attachment-sigma'):
+            settings[o[2:].replace('-', '_')] = float(a)
+        elif o in ('--attachment-median', '--attachment-max'):
+            settings[o[2:].replace('-', '_')] = int(a)
+        elif o == '--label':
+            label = a
+        elif o == '--repeat':
+            repeat = max(1, int(a))
+        elif o == '--results':
+            results_path = a
+        elif o == '--baseline':
+            baseline = a
+        elif o == '--threshold':
+            threshold = float(a)
+
+    if command == "generate":
+        if len(args) != 1:
+            usage()
+        settings['attachment_mu'] = math.log(settings['attachment_median'] * 1024)
+        settings['attachment_max'] = settings['attachment_max'] * 1024
+        manifest = generate(args[0], settings)
+        print "Wrote %d bugs, %.1f MB to %s" % (settings['bugs'],
+                                               manifest['bytes'] / 1048576.0, args[0])
+    elif command == "run":
+        if len(args) != 1:
+            usage()
+        best = None
+        for i in xrange(repeat):
+            result = run(args[0], label, importer_args)
+            if best is None or result['elapsed'] < best['elapsed']:
+                best = result
+        report(best)
+        f = open(results_path, "a")
+        f.write(json.dumps(best, sort_keys=True) + "\n")
+        f.close()
+    else:
+        results = load_results(results_path)
+        if not results:
+            sys.stderr.write("No results in %s\n" % results_path)
+            sys.exit(1)
+        regressions = compare(results, baseline, threshold / 100.0)
+        for line in regressions:
+            print "REGRESSION %s" % line
+        if regressions:
+            sys.exit(2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# This Source Code Form is "Incompatible With Secondary Licenses", as
+# defined by the Mozilla Public License, v. 2.0.
+
+"""
+jb2bz-test.py - end-to-end checks of jb2bz.py
+
+    jb2bz-test.py [-v] [TEST...]
+
+Each test writes a small JitterBug directory, imports it with jb2bz.py
+into a scratch SQLite database and checks what ended up there.  Nothing
+but Python 2 and the sqlite3 module is needed.
+"""
+
+import sys, os, shutil, sqlite3, subprocess, tempfile, unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+importer = os.path.join(here, "jb2bz.py")
+
+class ImportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="jb2bz-test.")
+        self.bugs = os.path.join(self.tmp, "bugs")
+        os.mkdir(self.bugs)
+        self.db = os.path.join(self.tmp, "bugs.db")
+        self.journal = os.path.join(self.tmp, "journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, True)
+
+    def write(self, name, text):
+        f = open(os.path.join(self.bugs, name), "wb")
+        f.write(text)
+        f.close()
+
+    def message(self, number, body, sender="someone@example.com"):
+        return ("From: %s\nSubject: bug %d\n"
+                "Date: Mon, 1 Jan 2001 10:00:00 +0000\n\n%s\n"
+                % (sender, number, body))
+
+    def attached(self, number, filename, data, sender="someone@example.com"):
+        return ("From: %s\nSubject: bug %d\n"
+                "Date: Mon, 1 Jan 2001 10:00:00 +0000\n"
+                "MIME-Version: 1.0\n"
+                "Content-Type: multipart/mixed; boundary=\"BB\"\n\n"
+                "--BB\nContent-Type: text/plain\n\nsee attached\n"
+                "--BB\nContent-Type: application/octet-stream\n"
+                "Content-Disposition: attachment; filename=\"%s\"\n\n"
+                "%s\n--BB--\n" % (sender, number, filename, data))
+
+    def jb2bz(self, *args):
+        """Run jb2bz.py on the bugs directory; returns (status, stdout)."""
+        command = [ sys.executable, importer, "-c", "comp", "-v", "1.0",
+                    "--db-driver=sqlite", "--db-name=%s" % self.db,
+                    "--journal=%s" % self.journal ] + list(args) + [ "Prod" ]
+        p = subprocess.Popen(command, cwd=self.bugs, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        return p.returncode, out, err
+
+    def query(self, sql, args=()):
+        db = sqlite3.connect(self.db)
+        db.text_factory = str
+        try:
+            return db.execute(sql, args).fetchall()
+        finally:
+            db.close()
+
+    def update(self, sql, args=()):
+        db = sqlite3.connect(self.db)
+        db.text_factory = str
+        try:
+            db.execute(sql, args)
+            db.commit()
+        finally:
+            db.close()
+
+class VerifyTest(ImportTest):
+
+    def test_non_utf8(self):
+        # JitterBug files are mostly Latin-1.
+        self.write("1", self.message(1, "caf\xe9 cr\xe8me"))
+        self.write("1.reply.1", self.message(1, "na\xefve \xff\xfe"))
+        self.write("2", self.message(2, "caf\xc3\xa9"))
+        self.write("3", self.message(3, "plain"))
+        status, out, err = self.jb2bz()
+        self.assertEqual(status, 0, err)
+        status, out, err = self.jb2bz("--verify")
+        self.assertEqual((status, out), (0, ""), err)
+
+    def test_changed(self):
+        self.write("1", self.message(1, "caf\xe9"))
+        self.write("2", self.message(2, "unchanged"))
+        self.write("3", self.message(3, "gone"))
+        self.assertEqual(self.jb2bz()[0], 0)
+        self.update("UPDATE longdescs SET thetext = ? WHERE bug_id = 1",
+                    [ "cafe\n" ])
+        self.update("DELETE FROM longdescs WHERE bug_id = 3")
+        self.update("DELETE FROM bugs_fulltext WHERE bug_id = 3")
+        self.update("DELETE FROM bugs WHERE bug_id = 3")
+        status, out, err = self.jb2bz("--verify")
+        self.assertEqual(status, 2)
+        self.assertEqual(out.splitlines(),
+                         [ "Bug 3 is missing",
+                           "Bug 1 differs from what was imported" ])
+
+class LazyParseTest(ImportTest):
+
+    def test_same_text(self):
+        self.write("1", self.message(1, "caf\xe9\n\nmore"))
+        self.write("1.reply.1", self.message(1, "reply"))
+        self.write("1.followup.1", self.attached(1, "core", "bytes"))
+        self.write("2", self.attached(2, "core", "other bytes"))
+        comments = "SELECT bug_id, thetext FROM longdescs ORDER BY comment_id"
+        self.assertEqual(self.jb2bz()[0], 0)
+        eager = self.query(comments)
+        os.unlink(self.db)
+        os.unlink(self.journal)
+        status, out, err = self.jb2bz("--lazy-parse", "--memory-budget=1")
+        self.assertEqual(status, 0, err)
+        self.assertEqual(self.query(comments), eager)
+
+class DedupTest(ImportTest):
+
+    def dedup(self, *args):
+        return self.jb2bz("--dedup-attachments", "--attachment-index=%s"
+                          % os.path.join(self.tmp, "index"), *args)
+
+    def identical(self):
+        return [ row[0] for row in self.query(
+            "SELECT thetext FROM longdescs WHERE thetext LIKE ?"
+            " ORDER BY comment_id", [ "%is identical to attachment%" ]) ]
+
+    def test_reimport_original(self):
+        self.write("1", self.attached(1, "core", "same bytes"))
+        self.write("2", self.attached(2, "core", "same bytes"))
+        self.assertEqual(self.dedup()[0], 0)
+        first = self.query("SELECT attach_id FROM attachments")
+        self.assertEqual(self.identical(),
+                         [ "core is identical to attachment %d on bug 1"
+                           % first[0] ])
+        # Bug 1 changes, so it is deleted and stored again.
+        self.write("1", self.attached(1, "core", "same bytes",
+                                      "other@example.com"))
+        status, out, err = self.dedup()
+        self.assertEqual(status, 0, err)
+        rows = self.query("SELECT attach_id, bug_id FROM attachments")
+        self.assertEqual(len(rows), 1)
+        self.assertNotEqual(rows[0][0], first[0][0])
+        self.assertEqual(self.identical(),
+                         [ "core is identical to attachment %d on bug 1"
+                           % rows[0][0] ])
+        status, out, err = self.jb2bz("--verify")
+        self.assertEqual((status, out), (0, ""), err)
+
+    def test_stale_index(self):
+        self.write("1", self.attached(1, "core", "same bytes"))
+        self.assertEqual(self.dedup()[0], 0)
+        self.update("DELETE FROM attach_data")
+        self.update("DELETE FROM attachments")
+        self.write("2", self.attached(2, "core", "same bytes"))
+        status, out, err = self.dedup()
+        self.assertEqual(status, 0, err)
+        self.assertTrue("Dropped 1 attachment index entries" in err, err)
+        self.assertEqual(self.query("SELECT bug_id FROM attachments"),
+                         [ (2,) ])
+        self.assertEqual(self.identical(), [])
+
+class RecoverTest(ImportTest):
+
+    def test_duplicate_attachment(self):
+        self.write("1", self.message(1, "first"))
+        self.assertEqual(self.jb2bz()[0], 0)
+        # An attach_data row with no attachment takes the next ID.
+        self.update("INSERT INTO attach_data (id, thedata) VALUES (1, 'x')")
+        self.write("2", self.attached(2, "core", "bytes"))
+        status, out, err = self.jb2bz()
+        self.assertEqual(status, 2)
+        self.assertTrue("Bug 2 not imported" in err, err)
+        self.assertEqual(self.query("SELECT bug_id FROM bugs"), [ (1,) ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,16 +10,39 @@ rights reserved. No guarantees expressed or implied. Use at your own
 risk. May be dangerous if swallowed. If it doesn't work for you, don't
 blame me. It did what I needed it to do.
 
-This code requires a recent version of Andy Dustman's MySQLdb interface,
+To import into MySQL or MariaDB, this code requires a recent version of
+Andy Dustman's MySQLdb interface,
 
     http://sourceforge.net/projects/mysql-python
 
+It can also write to a SQLite database, or export the bugs to a file.
+
 Share and enjoy.
 """
 
-import email, mimetypes, email.utils
-import sys, re, glob, os, stat, time
-import MySQLdb, getopt
+import email, mimetypes, email.utils, email.parser
+import sys, re, os, stat, time, signal, itertools, collections
+import multiprocessing, multiprocessing.pool, threading, Queue, tempfile
+import shutil, binascii, errno, subprocess, tarfile, zipfile, posixpath
+import hashlib, mmap, marshal
+import base64, gzip, json, sqlite3, heapq, contextlib, getopt
+from xml.sax.saxutils import escape, quoteattr
+
+# MySQLdb is only needed to write to MySQL or MariaDB.
+try:
+    import MySQLdb
+except ImportError:
+    MySQLdb = None
+
+# os.scandir() (or the scandir backport) hands back the stat information
+# the directory read already had; fall back to listdir() and stat().
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # mimetypes doesn't include everything we might encounter, yet.
 if not mimetypes.types_map.has_key('.doc'):
@@ -33,6 +56,117 @@ component="default"
 version="unspecified"
 product="" # this is required, the rest of these are defaulted as above
 
+# With --tree, the JitterBug directories under this root are all imported,
+# with product, version and status taken from their names (see below).
+tree_root = None
+
+# Read the bugs from this tar or zip archive instead of from directories.
+archive_path = None
+
+# Or thread the messages of this mbox file or Maildir into bugs, numbered
+# from first_bug on in the order their first messages are stored.
+mail_path = None
+first_bug = 1
+
+# Where the bugs go, and how often they are committed there.  db_driver is
+# a key of db_drivers; for sqlite, 'db' is the database file.
+db_driver = 'mysql'
+db_params = {'db': 'bugs', 'user': 'root', 'host': 'localhost', 'passwd': 'password'}
+commit_every = 100       # bugs per transaction
+commit_interval = 10.0   # seconds before a partial batch is committed anyway
+
+# To import into a Bugzilla that is in use, set throttle_target to the
+# number of seconds a batch's transaction may take; see Throttle.  Writes
+# also pause while replica lag, if there is a way to measure it, is over
+# max_replica_lag seconds: lag_command is a shell command that prints the
+# lag, and replica_host a MySQL replica to ask for it.
+throttle_target = None
+max_replica_lag = 10.0
+lag_command = None
+replica_host = None
+
+# Seconds to hold each SQLite transaction open, plus more per bug in it,
+# to try the throttle out against a database that is slow on purpose.
+inject_latency = None
+
+# Number of processes parsing bug files; 1 parses in the main process.
+jobs = 1
+
+# Number of writers, each with its own connection and transactions; see
+# ShardedWriter.  Writer i takes the bugs numbered from k * shard_range on,
+# for every k with k % writers == i.
+writers = 1
+shard_range = 1000
+
+# Depths of the bounded queues between the pipeline's stages: bugs read
+# ahead of the parser, and parsed bugs waiting for the writer.
+read_ahead = 32
+write_queue_size = 64
+
+# Memory-map bug files and parse only their headers up front; see
+# parse_lazy().  Files are then mapped by the parser, not read ahead.
+lazy_parse = False
+
+# With verify, check the bugs the journal recorded against the database
+# instead of importing, in ranges of verify_range bugs, verify_jobs at once.
+verify = False
+verify_jobs = 4
+verify_range = 1000
+
+# Keep parsed bugs in this directory, and reuse them while their files are
+# unchanged; see ParseCache.  It is trimmed to parse_cache_size bytes.
+parse_cache_path = None
+parse_cache_size = 1024 * 1024 * 1024
+
+# Bytes that the files read ahead of the parser and the comment text and
+# attachment data of parsed bugs waiting to be written may hold in memory
+# between them.  Past that, files aren't read ahead and bugs' bodies go to
+# disk until they are written.  See MemoryBudget.  None means no limit.
+memory_budget = None
+
+# Decoded attachments larger than this are spooled to a temporary file in
+# spool_dir, and are always decoded and written this many bytes at a time.
+attachment_spool_size = 1024 * 1024
+attachment_chunk_size = 1024 * 1024
+spool_dir = None
+
+# Bugzilla's attachments directory (data/attachments).  When it is set,
+# attachments larger than max_attachment_size KB (Bugzilla's
+# maxattachmentsize parameter) are stored there instead of in attach_data.
+attachdir = None
+max_attachment_size = 1000
+
+# Checkpoint journal of imported bugs, see Journal.
+journal_path = None
+
+# Store each distinct attachment once: later copies, in the same bug or any
+# other, are left out, and copies in another bug are replaced by a comment
+# pointing at the stored one.  With duplicate_comments, copies within a bug
+# get that comment too.  The SHA-256 of every stored attachment is kept in
+# attachment_index_path across runs; see AttachmentIndex.
+dedup_attachments = False
+duplicate_comments = False
+attachment_index_path = "jb2bz-attachments.idx"
+
+# Instead of writing to the database, bugs can be exported to a file in
+# importxml.pl's XML format or as JSON lines; see XMLExporter.
+export_path = None
+export_format = None
+export_gzip = False
+exporter = "nobody@localhost"
+urlbase = "http://localhost/"
+# importxml.pl only warns if this isn't its own BUGZILLA_VERSION.
+xml_version = "5.2+"
+
+# Where to write a JSON summary of the run (see jb2bz-bench.py), and how
+# often to report progress on stderr.
+stats_path = None
+progress_interval = None
+
+# Bug number whose parsing is run under cProfile, and where its profile goes.
+profile_bug = None
+profile_path = None
+
 """
 Each bug in JitterBug is stored as a text file named by the bug number.
 Additions to the bug are indicated by suffixes to this:
@@ -70,56 +204,824 @@ or
 <product-name>-<version>
 """
 
-def process_notes_file(current, fname):
+def _cpu():
+    t = os.times()
+    return t[0] + t[1]
+
+@contextlib.contextmanager
+def timed(timings, name):
+    """Add the calls, wall and CPU seconds of a with block to timings[name]."""
+    wall = time.time()
+    cpu = _cpu()
+    try:
+        yield
+    finally:
+        t = timings.get(name)
+        if t is None:
+            t = timings[name] = [0, 0.0, 0.0]
+        t[0] = t[0] + 1
+        t[1] = t[1] + time.time() - wall
+        t[2] = t[2] + _cpu() - cpu
+
+jb_file_re = re.compile(r"(\d+)(?:\.(notes)|\.(reply|followup)\.(.*))?$")
+
+def _suffix_key(entry):
+    """Sort key putting <bug>.reply.2 before <bug>.reply.10."""
+    suffix = entry[0].split('.', 2)[2]
+    if suffix.isdigit():
+        return (0, int(suffix), suffix)
+    return (1, 0, suffix)
+
+def index_directory(path=".", settings=None):
+    """Group the files of a JitterBug directory by bug number.
+
+    The directory is read exactly once.  The result maps each bug number to
+    a dict holding the (filename, stat) pair of the bug itself, of its
+    .notes file (or None) and lists of them for its replies and followups,
+    and the settings the bugs are filed with (see bug_settings()).  Unless
+    path is the current directory, filenames include it.  Companion files
+    of bugs that don't exist are ignored.
+    """
+    if settings is None:
+        settings = bug_settings()
+    bugs = {}
+    if scandir is not None:
+        entries = ((e.name, e) for e in scandir(path))
+    else:
+        entries = ((name, None) for name in os.listdir(path))
+
+    for name, entry in entries:
+        m = jb_file_re.match(name)
+        if m is None:
+            continue
+        if entry is not None:
+            st = entry.stat()
+        else:
+            st = os.stat(os.path.join(path, name))
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        if path != ".":
+            name = os.path.join(path, name)
+        _index_file(bugs, m, name, st, settings)
+    return _finish_index(bugs)
+
+def _index_file(bugs, m, name, st, settings):
+    """Add a file whose name matched jb_file_re to an index; returns its bug."""
+    number = int(m.group(1))
+    files = bugs.get(number)
+    if files is None:
+        files = bugs[number] = {'number': number, 'base': None,
+                                'notes': None, 'reply': [], 'followup': [],
+                                'settings': settings}
+    if m.group(2):
+        files['notes'] = (name, st)
+    elif m.group(3):
+        files[m.group(3)].append((name, st))
+    else:
+        files['base'] = (name, st)
+    return files
+
+def _finish_index(bugs):
+    for number in bugs.keys():
+        files = bugs[number]
+        if files['base'] is None:
+            del bugs[number]
+            continue
+        files['reply'].sort(key=_suffix_key)
+        files['followup'].sort(key=_suffix_key)
+    return bugs
+
+class MemberStat:
+    """What the importer uses of a stat result, for a member of an archive."""
+
+    def __init__(self, size, mtime):
+        self.st_size = size
+        self.st_mtime = mtime
+        self.st_mode = stat.S_IFREG | 0644
+
+def archive_members(path):
+    """Yield (name, MemberStat, contents) for each file in an archive.
+
+    Members are read in the order they are stored, in one pass: tar files
+    (compressed any way tarfile knows) as a stream, .zst ones through the
+    zstd program, and zip files entry by entry.
+    """
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        try:
+            for info in archive.infolist():
+                if info.filename.endswith("/"):
+                    continue
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                yield (info.filename, MemberStat(info.file_size, mtime),
+                       archive.read(info))
+        finally:
+            archive.close()
+        return
+
+    zstd = None
+    if path.endswith((".zst", ".tzst")):
+        try:
+            zstd = subprocess.Popen(["zstd", "-dcq", path], stdout=subprocess.PIPE)
+        except OSError, e:
+            raise IOError("can't run zstd to read %s: %s" % (path, e))
+        archive = tarfile.open(fileobj=zstd.stdout, mode="r|")
+    else:
+        archive = tarfile.open(path, mode="r|*")
+    try:
+        for member in archive:
+            if not member.isfile():
+                continue
+            f = archive.extractfile(member)
+            yield member.name, MemberStat(member.size, member.mtime), f.read()
+            # A stream can't go back to them, but tarfile keeps every
+            # member's TarInfo all the same.
+            archive.members = []
+    finally:
+        archive.close()
+        if zstd is not None:
+            zstd.stdout.close()
+            if zstd.wait() not in (0, -signal.SIGPIPE):
+                raise IOError("zstd couldn't read %s" % path)
+
+def index_archive(path, settings_for):
+    """Index the JitterBug files of an archive as it is read.
+
+    Yields (directory, index) pairs, an index being what index_directory()
+    would return for that directory of the archive, with where each of a
+    bug's files is in its 'spooled'.  settings_for(directory) gives the
+    settings for a directory's bugs, or None to skip it.
+
+    Member contents are not kept in memory: they are copied to a spool file
+    in spool_dir as they are read, and only their places in it (as Spilled)
+    are kept, to be read back with read_member() when the bug is read.
+
+    Archivers store the files of a directory together, so a directory is
+    done with as soon as the archive moves on to another one.  Files that
+    turn up after that are reported and skipped.
+    """
+    bugs = {}
+    directory = None
+    settings = None
+    done = set()
+    fd, spool_path = tempfile.mkstemp(prefix="archive.", dir=spool_dir)
+    spool = os.fdopen(fd, "wb")
+    offset = 0
     try:
-        new_note = {}
-        notes = open(fname, "r")
-        s = os.fstat(notes.fileno())
+        for name, st, contents in archive_members(path):
+            m = jb_file_re.match(posixpath.basename(name))
+            if m is None:
+                continue
+            d = posixpath.dirname(name)
+            if d != directory:
+                if bugs:
+                    spool.flush()
+                    yield directory, _finish_index(bugs)
+                    bugs = {}
+                done.add(directory)
+                directory = d
+                if d in done:
+                    sys.stderr.write("%s: the files of %s aren't stored together;"
+                                     " skipping the rest of them\n" % (path, d))
+                    settings = None
+                else:
+                    settings = settings_for(d)
+            if settings is None:
+                continue
+            files = _index_file(bugs, m, name, st, settings)
+            spool.write(contents)
+            files.setdefault('spooled', {})[name] = Spilled(spool_path, offset,
+                                                            len(contents))
+            offset = offset + len(contents)
+        if bugs:
+            spool.flush()
+            yield directory, _finish_index(bugs)
+    finally:
+        spool.close()
+
+def bug_settings():
+    """What the bugs of a directory are filed with, from the options."""
+    return {'product': product, 'component': component, 'version': version,
+            'bug_status': bug_status, 'resolution': resolution,
+            'bug_severity': 'normal'}
+
+# <product-name>[-<version>]-<kind>; a version starts with a digit, so that
+# product names can contain dashes.
+tree_dir_re = re.compile(r"(.+?)(?:-(\d[^-]*))?-(bugs|requests|resolved|verified)$")
+
+# What each kind of directory is filed as.
+tree_kinds = {
+    'bugs':     {'bug_status': 'CONFIRMED', 'resolution': '',
+                 'bug_severity': 'normal'},
+    'requests': {'bug_status': 'CONFIRMED', 'resolution': '',
+                 'bug_severity': 'enhancement'},
+    'resolved': {'bug_status': 'RESOLVED', 'resolution': 'FIXED',
+                 'bug_severity': 'normal'},
+    'verified': {'bug_status': 'VERIFIED', 'resolution': 'FIXED',
+                 'bug_severity': 'normal'},
+}
+
+def discover_tree(root):
+    """Find the JitterBug directories in root.
+
+    Returns a list of (path, settings) pairs, in order of path.  Bugs are
+    filed under the component given with -c, and under the version given
+    with -v if the directory's name has none.
+    """
+    found = []
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        settings = tree_settings(name)
+        if settings is not None and os.path.isdir(path):
+            found.append((path, settings))
+    return found
+
+def tree_settings(name):
+    """The settings for the bugs of a directory in a tree, or None."""
+    m = tree_dir_re.match(name)
+    if m is None:
+        return None
+    settings = bug_settings()
+    settings.update(tree_kinds[m.group(3)])
+    settings['product'] = m.group(1)
+    if m.group(2):
+        settings['version'] = m.group(2)
+    return settings
+
+def index_tree(directories):
+    """index_directory() all of directories, several at once, into one index.
+
+    A bug number can only be imported once; if it turns up in more than
+    one directory, the first one's is imported and the others reported.
+    """
+    pool = multiprocessing.pool.ThreadPool(max(1, min(len(directories), 8)))
+    try:
+        indexes = pool.map(lambda d: index_directory(*d), directories)
+    finally:
+        pool.close()
+        pool.join()
+    index = {}
+    for (path, settings), entries in zip(directories, indexes):
+        for number in sorted(entries):
+            if number in index:
+                sys.stderr.write("Bug %d is in both %s and %s; importing the first\n"
+                                 % (number, os.path.dirname(index[number]['base'][0]),
+                                    path))
+                continue
+            index[number] = entries[number]
+    return index
+
+def _bug_files(files):
+    """All of a bug's (filename, stat) pairs, in a fixed order."""
+    result = [files['base']]
+    if files['notes'] is not None:
+        result.append(files['notes'])
+    return result + files['reply'] + files['followup']
+
+def files_signature(files):
+    """A cheap fingerprint of a bug's files, made from their stat results."""
+    h = hashlib.sha1()
+    for name, st in _bug_files(files):
+        h.update("%s %d %r\n" % (name, st.st_size, st.st_mtime))
+    return h.hexdigest()
+
+def files_digest(files):
+    """A SHA-256 digest of the names and contents of a bug's files."""
+    h = hashlib.sha256()
+    contents = files.get('contents')
+    spooled = files.get('spooled', {})
+    for name, st in _bug_files(files):
+        h.update("%s\n" % name)
+        if contents is not None:
+            h.update(contents[name])
+            continue
+        if name in spooled:
+            h.update(spooled[name].read())
+            continue
+        f = open(name, "rb")
+        while True:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            h.update(chunk)
+        f.close()
+    return h.hexdigest()
+
+def read_bug(files):
+    """Load the contents of all of a bug's files, ahead of parsing it."""
+    files = dict(files)
+    files['timings'] = {}
+    if parse_cache is not None:
+        with timed(files['timings'], 'cache'):
+            cached = parse_cache.lookup(files)
+        if cached is not None:
+            # Nothing to read or parse.
+            files['cached'] = cached
+            files.pop('contents', None)
+            files.pop('spooled', None)
+            return files
+    if lazy_parse:
+        # To be mapped by the parser.
+        return files
+    if 'contents' not in files:
+        size = sum([ st.st_size for name, st in _bug_files(files) ])
+        if budget is not None and not budget.fits(size):
+            # The parser reads them itself, when it gets to them.
+            return files
+        files['contents'] = {}
+        with timed(files['timings'], 'read'):
+            for name, st in _bug_files(files):
+                files['contents'][name] = read_member(files, name)
+    # (A mailbox's are read already, and in memory just the same.)
+    if budget is not None:
+        budget.charge(files, sum(map(len, files['contents'].values())))
+    return files
+
+def read_member(files, name):
+    """The contents of one of a bug's files, from the archive spool file if
+    it came from an archive."""
+    spooled = files.get('spooled')
+    if spooled is not None and name in spooled:
+        return spooled[name].read()
+    f = open(name, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def read_file(current, fname):
+    """The contents of fname, from read_bug() if it was read ahead."""
+    if fname in current['contents']:
+        return current['contents'].pop(fname)
+    with timed(current['timings'], 'read'):
+        return read_member(current, fname)
 
-        new_note['text']  = notes.read()
-        new_note['timestamp'] = time.gmtime(s[stat.ST_MTIME])
+class Spilled(object):
+    """A body on disk: prefix, then length bytes at offset in the file at
+    path.  The file is a spool file, or the one a message was mapped from."""
 
-        notes.close()
+    __slots__ = ('path', 'offset', 'length', 'prefix')
 
-        current['notes'].append(new_note)
+    def __init__(self, path, offset, length, prefix=""):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.prefix = prefix
 
+    def read(self):
+        f = open(self.path, "rb")
+        try:
+            f.seek(self.offset)
+            return self.prefix + f.read(self.length)
+        finally:
+            f.close()
+
+def body_text(body):
+    """The text of a body, which is a string or Spilled."""
+    if isinstance(body, Spilled):
+        return body.read()
+    return body
+
+class Note(object):
+    """A comment after the description.
+
+    who is the sender as message_sender() returns it, and when the time in
+    seconds since the epoch.  The text is kept in body; see body_text().
+    """
+
+    __slots__ = ('body', 'who', 'when')
+
+    def __init__(self, text, who, when):
+        self.body = text
+        self.who = who
+        self.when = when
+
+    text = property(lambda self: body_text(self.body))
+
+class Attachment(object):
+    """A decoded attachment, with its Payload and sender."""
+
+    __slots__ = ('filename', 'mimetype', 'payload', 'who')
+
+    def __init__(self, filename, mimetype, payload, who):
+        self.filename = filename
+        self.mimetype = mimetype
+        self.payload = payload
+        self.who = who
+
+def message_time(msg):
+    """When msg was sent, in seconds since the epoch."""
+    return email.utils.mktime_tz(email.utils.parsedate_tz(msg['Date']))
+
+def process_notes_file(current, fname, s):
+    try:
+        current['notes'].append(Note(read_file(current, fname), None,
+                                     int(s.st_mtime)))
     except IOError:
         pass
 
+def read_message(current, fname):
+    if lazy_parse:
+        return read_message_lazy(current, fname)
+    text = read_file(current, fname)
+    with timed(current['timings'], 'mime'):
+        return email.message_from_string(text)
+
+class _NotLazy(Exception):
+    """A message parse_lazy() leaves to the email package."""
+
+class LazyPart(email.message.Message):
+    """A message or MIME part whose body stays in the file it came from.
+
+    Only the headers are parsed into the Message.  The body is the range
+    start:end of data, a mapped file or a string, and is only copied out
+    when get_payload() asks for it as a string.  Multipart bodies are
+    split into LazyParts when parsed, so walk() works as usual.
+    """
+
+    data = None
+    start = end = 0
+    # The file data is at some offset of, as (path, offset), if it is one.
+    place = None
+
+    def get_payload(self, i=None, decode=False):
+        if self.data is not None and not self.is_multipart():
+            self.set_payload(self.data[self.start:self.end])
+            self.data = None
+        return email.message.Message.get_payload(self, i, decode)
+
+    def chunks(self, size):
+        """Yield views of the body, about size bytes each, ending at newlines.
+
+        Python 2's mmap doesn't support memoryview, so views of a mapped
+        file are buffers; either way nothing is copied.
+        """
+        data = self.data
+        try:
+            view = memoryview(data)
+        except TypeError:
+            view = None
+        start = self.start
+        while start < self.end:
+            end = data.find("\n", start + size, self.end)
+            if end < 0:
+                end = self.end
+            else:
+                end = end + 1
+            if view is not None:
+                yield view[start:end]
+            else:
+                yield buffer(data, start, end - start)
+            start = end
+
+    def decode(self):
+        """Decode the body straight from data into a Payload.
+
+        Returns None for bodies decode_payload() must handle as a string:
+        uuencoded ones, and base64 whose lines don't hold whole groups of
+        four characters.
+        """
+        cte = self.get('content-transfer-encoding', '').strip().lower()
+        if cte in ('x-uuencode', 'uuencode', 'uue', 'x-uue'):
+            return None
+        payload = Payload()
+        try:
+            for chunk in self.chunks(attachment_chunk_size):
+                if cte == 'base64':
+                    payload.write(binascii.a2b_base64(chunk))
+                elif cte == 'quoted-printable':
+                    payload.write(binascii.a2b_qp(chunk))
+                elif isinstance(chunk, memoryview):
+                    payload.write(chunk.tobytes())
+                else:
+                    payload.write(chunk[:])
+        except binascii.Error:
+            payload.discard()
+            return None
+        payload.finish()
+        return payload
+
+_lazy_header_parser = email.parser.HeaderParser(_class=LazyPart)
+
+def _split_headers(data, start, end):
+    """The header block of data[start:end] and where the body starts."""
+    for blank in ("\n", "\r\n"):
+        if data[start:start + len(blank)] == blank:
+            return "", start + len(blank)
+    found = [ (i + len(sep), i + 1) for i, sep
+              in [ (data.find(sep, start, end), sep) for sep in ("\n\n", "\n\r\n") ]
+              if i >= 0 ]
+    if not found:
+        return data[start:end], end
+    body, headers_end = min(found)
+    return data[start:headers_end], body
+
+def _part_ranges(data, boundary, start, end):
+    """The (start, end) of each part of a multipart body in data[start:end].
+
+    Delimiters are recognized as email.feedparser does; the line break
+    before one belongs to it.  Raises _NotLazy if there is no closing
+    delimiter.
+    """
+    sep = "--" + boundary
+    ranges = []
+    part = None
+    pos = start
+    i = None
+    if data[start:start + len(sep)] == sep:
+        # A delimiter can start the body without a line break before it.
+        i = start
+    while True:
+        if i is None:
+            i = data.find("\n" + sep, pos, end)
+            if i < 0:
+                raise _NotLazy()
+            i = i + 1
+        line_end = data.find("\n", i, end)
+        if line_end < 0:
+            line_end = end
+        rest = data[i + len(sep):line_end].rstrip("\r")
+        close = rest.startswith("--")
+        if close:
+            rest = rest[2:]
+        if rest.strip(" \t"):
+            # Only starts like a delimiter.
+            pos = i
+            i = None
+            continue
+        if part is not None:
+            part_end = i - 1
+            if data[part_end - 1:part_end] == "\r":
+                part_end = part_end - 1
+            ranges.append((part, max(part, part_end)))
+        if close:
+            return ranges
+        part = min(line_end + 1, end)
+        pos = line_end
+        i = None
+
+def _lazy_part(data, start, end):
+    headers, body = _split_headers(data, start, end)
+    msg = _lazy_header_parser.parsestr(headers, True)
+    if email.message.Message.get_payload(msg):
+        # The headers ended early, at a line that isn't one.
+        raise _NotLazy()
+    maintype = msg.get_content_maintype()
+    if maintype == 'message':
+        # The email package parses these into sub-messages.
+        raise _NotLazy()
+    if maintype == 'multipart':
+        boundary = msg.get_boundary()
+        if not boundary:
+            raise _NotLazy()
+        msg.set_payload([ _lazy_part(data, s, e)
+                          for s, e in _part_ranges(data, boundary, body, end) ])
+    else:
+        msg.data = data
+        msg.start = body
+        msg.end = end
+    return msg
+
+def parse_lazy(data):
+    """Parse a message from data, a mapped file or a string, header first.
+
+    Only multipart messages are split into parts; a single-part body is
+    left in data until it's asked for, and attachments are decoded from it
+    by LazyPart.decode().  Raises _NotLazy for messages whose structure
+    this doesn't reproduce exactly the way the email package would.
+    """
+    return _lazy_part(data, 0, len(data))
+
+def map_file(fname):
+    """A read-only mmap of fname, or "" if it's empty."""
+    f = open(fname, "rb")
+    try:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        # The map keeps its own descriptor.
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+def read_message_lazy(current, fname):
+    # A mailbox's messages aren't anywhere on disk as they are.
+    place = None
+    if fname in current['contents']:
+        data = current['contents'].pop(fname)
+    elif fname in current['spooled']:
+        spooled = current['spooled'][fname]
+        place = (spooled.path, spooled.offset)
+        with timed(current['timings'], 'read'):
+            data = read_member(current, fname)
+    else:
+        place = (fname, 0)
+        with timed(current['timings'], 'read'):
+            data = map_file(fname)
+    with timed(current['timings'], 'mime'):
+        try:
+            msg = parse_lazy(data)
+        except _NotLazy:
+            return email.message_from_string(data[:])
+    for part in msg.walk():
+        part.place = place
+    return msg
+
+def text_body(part, prefix=""):
+    """The body of a text part, after prefix, as a description or note
+    keeps it: where it is on disk if the part was mapped from a file,
+    otherwise a copy."""
+    if isinstance(part, LazyPart) and part.data is not None and part.place:
+        path, offset = part.place
+        return Spilled(path, offset + part.start, part.end - part.start, prefix)
+    if prefix:
+        return prefix + part.get_payload()
+    return part.get_payload()
+
+def message_sender(msg):
+    """The (realname, address) a message is from, or None if it has none."""
+    realname, address = email.utils.parseaddr(msg.get('From', ''))
+    if '@' not in address:
+        return None
+    return (realname, address)
+
 def process_reply_file(current, fname):
-    new_note = {}
-    reply = open(fname, "r")
-    msg = email.message_from_file(reply)
+    msg = read_message(current, fname)
+    who = message_sender(msg)
 
     # Add any attachments that may have been in a followup or reply
     msgtype = msg.get_content_maintype()
     if msgtype == "multipart":
         for part in msg.walk():
-            new_note = {}
             if part.get_filename() is None:
                 if part.get_content_type() == "text/plain":
-                    new_note['timestamp'] = time.gmtime(email.utils.mktime_tz(email.utils.parsedate_tz(msg['Date'])))
-                    new_note['text'] = "%s\n%s" % (msg['From'], part.get_payload())
-                    current["notes"].append(new_note)
+                    current["notes"].append(
+                        Note(text_body(part, "%s\n" % msg['From']), who,
+                             message_time(msg)))
             else:
-                maybe_add_attachment(part, current)
+                maybe_add_attachment(part, current, who)
     else:
-        new_note['text'] = "%s\n%s" % (msg['From'], msg.get_payload())
-        new_note['timestamp'] = time.gmtime(email.utils.mktime_tz(email.utils.parsedate_tz(msg['Date'])))
-        current["notes"].append(new_note)
+        current["notes"].append(
+            Note(text_body(msg, "%s\n" % msg['From']), who,
+                 message_time(msg)))
 
-def add_notes(current):
+def add_notes(current, files):
     """Add any notes that have been recorded for the current bug."""
-    process_notes_file(current, "%d.notes" % current['number'])
+    with timed(current['timings'], 'notes'):
+        _add_notes(current, files)
+
+def _add_notes(current, files):
+    if files['notes'] is not None:
+        process_notes_file(current, *files['notes'])
 
-    for f in glob.glob("%d.reply.*" % current['number']):
+    for f, s in files['reply']:
         process_reply_file(current, f)
 
-    for f in glob.glob("%d.followup.*" % current['number']):
+    for f, s in files['followup']:
         process_reply_file(current, f)
 
-def maybe_add_attachment(submsg, current):
+class Payload:
+    """The decoded contents of an attachment.
+
+    Data is kept in memory until it grows past attachment_spool_size and is
+    then moved to a temporary file.  Either way a Payload only holds plain
+    strings, so it can be handed between processes.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.data = []
+        self.path = None
+        self.sha256 = None
+        self.hash = hashlib.sha256()
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        self.size = self.size + len(chunk)
+        self.hash.update(chunk)
+        if self.path is None:
+            self.data.append(chunk)
+            if self.size <= attachment_spool_size:
+                return
+            fd, self.path = tempfile.mkstemp(prefix="attachment.", dir=spool_dir)
+            f = os.fdopen(fd, "wb")
+            f.writelines(self.data)
+            self.data = []
+        else:
+            f = open(self.path, "ab")
+            f.write(chunk)
+        f.close()
+
+    def chunks(self, size=None):
+        """Yield the contents at most size bytes at a time."""
+        size = size or attachment_chunk_size
+        if self.path is None:
+            data = "".join(self.data)
+            for i in xrange(0, len(data), size):
+                yield data[i:i + size]
+            return
+        f = open(self.path, "rb")
+        try:
+            while True:
+                chunk = f.read(size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+
+    def spill(self):
+        """Move the contents to a temporary file, if they are in memory."""
+        if self.path is not None or not self.data:
+            return
+        fd, self.path = tempfile.mkstemp(prefix="attachment.", dir=spool_dir)
+        f = os.fdopen(fd, "wb")
+        f.writelines(self.data)
+        f.close()
+        self.data = []
+
+    def finish(self):
+        """Done writing: note the SHA-256 of the contents in sha256.
+
+        The hash object can't be pickled, so this must be called before the
+        Payload leaves the process that decoded it.
+        """
+        self.sha256 = self.hash.hexdigest()
+        self.hash = None
+
+    def read(self):
+        return "".join(self.chunks())
+
+    def discard(self):
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.path = None
+        self.data = []
+
+def _line_chunks(text, size):
+    """Split text into pieces of about size characters, ending at newlines."""
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start + size)
+        if end < 0:
+            end = len(text)
+        else:
+            end = end + 1
+        yield text[start:end]
+        start = end
+
+def decode_payload(submsg):
+    """Decode a non-multipart part into a Payload, a chunk at a time.
+
+    Decoding the way get_payload(decode=True) does would build the whole
+    decoded string in memory; here at most one chunk of it is.  Returns None
+    if the part has no usable payload.
+    """
+    if isinstance(submsg, LazyPart) and submsg.data is not None:
+        payload = submsg.decode()
+        if payload is not None:
+            return payload
+    text = submsg.get_payload()
+    if not isinstance(text, basestring):
+        return None
+    cte = submsg.get('content-transfer-encoding', '').strip().lower()
+    payload = Payload()
+    if cte == 'base64':
+        carry = ""
+        try:
+            for chunk in _line_chunks(text, attachment_chunk_size):
+                chunk = carry + "".join(chunk.split())
+                usable = len(chunk) - len(chunk) % 4
+                carry = chunk[usable:]
+                payload.write(binascii.a2b_base64(chunk[:usable]))
+            if carry:
+                payload.write(binascii.a2b_base64(carry))
+        except binascii.Error:
+            # Same as get_payload(decode=True): keep the undecodable text.
+            payload.discard()
+            payload = Payload()
+            for chunk in _line_chunks(text, attachment_chunk_size):
+                payload.write(chunk)
+    elif cte == 'quoted-printable':
+        for chunk in _line_chunks(text, attachment_chunk_size):
+            payload.write(binascii.a2b_qp(chunk))
+    elif cte in ('x-uuencode', 'uuencode', 'uue', 'x-uue'):
+        payload.write(submsg.get_payload(decode=True))
+    else:
+        for chunk in _line_chunks(text, attachment_chunk_size):
+            payload.write(chunk)
+    payload.finish()
+    return payload
+
+def maybe_add_attachment(submsg, current, who=None):
     """Adds the attachment to the current record"""
+    with timed(current['timings'], 'attachments'):
+        _maybe_add_attachment(submsg, current, who)
+
+def _maybe_add_attachment(submsg, current, who):
     attachment_filename = submsg.get_filename()
     if attachment_filename is None:
         return
@@ -145,43 +1047,73 @@ def maybe_add_attachment(submsg, current):
         return
 
     try:
-        data = submsg.get_payload(decode=True)
+        data = decode_payload(submsg)
     except:
         return
+    if data is None:
+        return
 
-    current['attachments'].append( ( attachment_filename, mtype, data ) )
+    current['attachments'].append(Attachment(attachment_filename, mtype, data, who))
 
 def process_text_plain(msg, current):
-    current['description'] = msg.get_payload()
+    current['description'] = text_body(msg)
 
 def process_multi_part(msg, current):
     for part in msg.walk():
         if part.get_filename() is None:
             process_text_plain(part, current)
         else:
-            maybe_add_attachment(part, current)
+            maybe_add_attachment(part, current, current['who'])
+
+def process_jitterbug(files):
+    """Parse a bug, given its entry from index_directory() or read_bug()."""
+    timings = dict(files.get('timings', {}))
+    with timed(timings, 'bug'):
+        current = _process_jitterbug(files, timings)
+    del current['contents']
+    del current['spooled']
+    return current
 
-def process_jitterbug(filename):
+def new_bug(files, timings):
+    """The record for a bug, with what is known before parsing it."""
     current = {}
-    current['number'] = int(filename)
+    current['timings'] = timings
+    current['number'] = files['number']
     current['notes'] = []
     current['attachments'] = []
     current['description'] = ''
-    current['date-reported'] = ()
+    current['date-reported'] = 0
     current['short-description'] = ''
+    current['files'] = len(_bug_files(files))
+    current['bytes'] = sum([ st.st_size for name, st in _bug_files(files) ])
+    current.update(files['settings'])
+    current['replace'] = files.get('replace', False)
+    current['signature'] = files_signature(files)
+    return current
+
+def _process_jitterbug(files, timings):
+    filename, create_date = files['base']
+    current = new_bug(files, timings)
+    current['contents'] = dict(files.get('contents', {}))
+    current['spooled'] = files.get('spooled', {})
+    current['digest'] = files.get('digest')
+    if current['digest'] is None and (journal_path is not None or
+                                      parse_cache is not None):
+        # Only the journal and the parse cache keep it; it means reading
+        # every file of the bug through once more.
+        current['digest'] = files_digest(files)
 
     print "Processing: %d" % current['number']
 
-    mfile = open(filename, "r")
-    create_date = os.fstat(mfile.fileno())
-    msg = email.message_from_file(mfile)
+    msg = read_message(current, filename)
+    current['who'] = message_sender(msg)
 
-    current['date-reported'] = time.gmtime(email.utils.mktime_tz(email.utils.parsedate_tz(msg['Date'])))
+    current['date-reported'] = message_time(msg)
     if current['date-reported'] is None:
-       current['date-reported'] = time.gmtime(create_date[stat.ST_MTIME])
+       current['date-reported'] = int(create_date.st_mtime)
 
-    if current['date-reported'][0] < 1900:
-       current['date-reported'] = time.gmtime(create_date[stat.ST_MTIME])
+    if time.gmtime(current['date-reported'])[0] < 1900:
+       current['date-reported'] = int(create_date.st_mtime)
 
     if msg.has_key('Subject') is not False:
         current['short-description'] = msg['Subject']
@@ -198,152 +1130,3435 @@ def process_jitterbug(filename):
         print "Unknown content-type: %s" % msgtype
         sys.exit(1)
 
-    add_notes(current)
-
-    # At this point we have processed the message: we have all of the notes and
-    # attachments stored, so it's time to add things to the database.
-    # The schema for JitterBug 2.14 can be found at:
-    #
-    #    http://www.trilobyte.net/barnsons/html/dbschema.html
-    #
-    # The following fields need to be provided by the user:
-    #
-    # bug_status
-    # product
-    # version
-    # reporter
-    # component
-    # resolution
-
-    # change this to the user_id of the Bugzilla user who is blessed with the
-    # imported defects
-    reporter=6
-
-    # the resolution will need to be set manually
-    resolution=""
-
-    db = MySQLdb.connect(db='bugs',user='root',host='localhost',passwd='password')
-    cursor = db.cursor()
+    add_notes(current, files)
+
+    return current
 
+# At this point we have processed the message: we have all of the notes and
+# attachments stored, so it's time to add things to the database.
+# The schema for JitterBug 2.14 can be found at:
+#
+#    http://www.trilobyte.net/barnsons/html/dbschema.html
+#
+# The following fields need to be provided by the user:
+#
+# bug_status
+# product
+# version
+# reporter
+# component
+# resolution
+
+# change this to the user_id of the Bugzilla user who is blessed with the
+# imported defects; bugs, notes and attachments from an address that has a
+# Bugzilla account are attributed to that account instead
+reporter=6
+
+# Create accounts for senders that don't have one, rather than attributing
+# what they sent to reporter.
+create_users = False
+
+# Drop the full-text indexes of bugs_fulltext for the import and build them
+# again once at the end, instead of updating them row by row.
+defer_fulltext = False
+
+# For a first import into an empty or offline database: load with the
+# secondary indexes and foreign keys of bulk_tables dropped and constraint
+# checks off, and restore them at the end.  What was dropped is recorded in
+# bulk_state_path until it has been restored and verified.
+bulk_load = False
+bulk_state_path = "jb2bz-bulk-state.json"
+bulk_tables = ("bugs", "longdescs", "bugs_fulltext", "attachments",
+               "attach_data")
+
+# The FULLTEXT indexes on bugs_fulltext, from Bugzilla/DB/Schema.pm.
+fulltext_indexes = [
+    ('bugs_fulltext_short_desc_idx', 'short_desc'),
+    ('bugs_fulltext_comments_idx', 'comments'),
+    ('bugs_fulltext_comments_noprivate_idx', 'comments_noprivate'),
+]
+
+# the resolution will need to be set manually
+resolution=""
+
+# Multi-row INSERTs are split so that no single statement grows much past
+# this many bytes of data (keep it well below max_allowed_packet).
+max_statement_bytes = 8 * 1024 * 1024
+
+def _ts(t):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(t))
+
+def local_attachment_path(attach_id):
+    """Where Bugzilla::Attachment keeps a locally stored attachment."""
+    group = "group.%s" % str((attach_id % 100) + 100)[-2:]
+    return os.path.join(attachdir, group, "attachment.%d" % attach_id)
+
+def _clone_file(src, dst):
+    """Make dst a copy of src, sharing its blocks where the filesystem can."""
     try:
-        cursor.execute( "INSERT INTO bugs SET " \
-                        "bug_id=%s," \
-                        "priority='---'," \
-                        "bug_severity='normal',"  \
-                        "op_sys='All'," \
-                        "bug_status=%s," \
-                        "creation_ts=%s,"  \
-                        "delta_ts=%s,"  \
-                        "short_desc=%s," \
-                        "product_id=%s," \
-                        "rep_platform='All'," \
-                        "assigned_to=%s," \
-                        "reporter=%s," \
-                        "version=%s,"  \
-                        "component_id=%s,"  \
-                        "resolution=%s",
-                        [ current['number'],
-                          bug_status,
-                          time.strftime("%Y-%m-%d %H:%M:%S", current['date-reported'][:9]),
-                          time.strftime("%Y-%m-%d %H:%M:%S", current['date-reported'][:9]),
-                          current['short-description'],
-                          product,
-                          reporter,
-                          reporter,
-                          version,
-                          component,
-                          resolution] )
-
-        # This is the initial long description associated with the bug report
-        cursor.execute( "INSERT INTO longdescs SET " \
-                        "bug_id=%s," \
-                        "who=%s," \
-                        "bug_when=%s," \
-                        "thetext=%s",
-                        [ current['number'],
-                          reporter,
-                          time.strftime("%Y-%m-%d %H:%M:%S", current['date-reported'][:9]),
-                          current['description'] ] )
-
-        # Add whatever notes are associated with this defect
-        for n in current['notes']:
-                            cursor.execute( "INSERT INTO longdescs SET " \
-                            "bug_id=%s," \
-                            "who=%s," \
-                            "bug_when=%s," \
-                            "thetext=%s",
-                            [current['number'],
-                             reporter,
-                             time.strftime("%Y-%m-%d %H:%M:%S", n['timestamp'][:9]),
-                             n['text']])
-
-        # add attachments associated with this defect
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        import fcntl
+        FICLONE = 0x40049409
+        s = open(src, "rb")
+        d = open(dst, "wb")
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return
+        finally:
+            s.close()
+            d.close()
+    except (ImportError, IOError, OSError):
+        pass
+    shutil.copyfile(src, dst)
+
+def store_local_attachment(attach_id, payload):
+    """Write an attachment to the local store; returns the file's path."""
+    path = local_attachment_path(attach_id)
+    directory = os.path.dirname(path)
+    try:
+        os.mkdir(directory, 0770)
+        os.chmod(directory, 0770)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    if payload.path is not None:
+        _clone_file(payload.path, path)
+    else:
+        f = open(path, "wb")
+        for chunk in payload.chunks():
+            f.write(chunk)
+        f.close()
+    os.chmod(path, 0660)
+    return path
+
+class MemoryBudget:
+    """Accounts for the memory held by bugs between reading and writing.
+
+    The files of a bug read ahead of the parser are charged by read_bug()
+    and released once the bug has been parsed, so bugs waiting for the
+    parser and in flight in it count.  Files that don't fit are not read
+    ahead.  Parsed bugs are admitted as they leave the parser and
+    released once written (or given up on); a bug that doesn't fit in what
+    is left of limit has its description, comments and attachment data
+    moved to disk first, see spill_bug().  The budget is shared by every
+    thread of the import.
+
+    Files the parser reads for itself, and lazily parsed ones, which are
+    mapped rather than read, are not charged; nor is text that is still
+    in them (see text_body()).
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.spilled = 0
+        self.lock = threading.Lock()
+
+    def fits(self, size):
+        return self.used + size <= self.limit
+
+    def admit(self, current):
+        size = bug_body_size(current)
+        with self.lock:
+            spill = self.used + size > self.limit
+        if spill:
+            spill_bug(current)
+            size = bug_body_size(current)
+        with self.lock:
+            if spill:
+                self.spilled = self.spilled + 1
+            self.used = self.used + size
+            self.peak = max(self.peak, self.used)
+        current['charged'] = size
+
+    def charge(self, files, size):
+        """Charge size bytes of files read ahead, until release(files)."""
+        with self.lock:
+            self.used = self.used + size
+            self.peak = max(self.peak, self.used)
+        files['charged'] = size
+
+    def release(self, current):
+        with self.lock:
+            self.used = self.used - current.pop('charged', 0)
+
+# The import's MemoryBudget, if memory_budget is set.
+budget = None
+
+def bug_body_size(current):
+    """Bytes of current's description, comments and attachments in memory."""
+    size = 0
+    for body in [ current['description'] ] + [ n.body for n in current['notes'] ]:
+        if isinstance(body, str):
+            size = size + len(body)
+    for a in current['attachments']:
+        if a.payload.path is None:
+            size = size + a.payload.size
+    return size
+
+def spill_bug(current):
+    """Move the bodies of a parsed bug to disk until it has been written.
+
+    Comment text goes to one file per bug, and is replaced by where it is
+    in that file; attachment data goes to the Payloads' own files.
+    """
+    fd, path = tempfile.mkstemp(prefix="bug.", dir=spool_dir)
+    f = os.fdopen(fd, "wb")
+    try:
+        offset = 0
+        bodies = [ current['description'] ] + [ n.body for n in current['notes'] ]
+        spilled = []
+        for body in bodies:
+            if not isinstance(body, str):
+                # Already spilled, or not text at all.
+                spilled.append(body)
+                continue
+            f.write(body)
+            spilled.append(Spilled(path, offset, len(body)))
+            offset = offset + len(body)
+    finally:
+        f.close()
+    current['description'] = spilled[0]
+    for n, body in zip(current['notes'], spilled[1:]):
+        n.body = body
+    current['spill'] = path
+    for a in current['attachments']:
+        a.payload.spill()
+
+def release_bugs(bugs):
+    """Free what written (or abandoned) bugs hold: memory and spool files."""
+    for current in bugs:
+        for a in current['attachments']:
+            a.payload.discard()
+        if 'spill' in current:
+            try:
+                os.unlink(current.pop('spill'))
+            except OSError:
+                pass
+        if budget is not None:
+            budget.release(current)
+
+class ParseCache:
+    """Parsed bugs on disk, for repeated imports of the same files.
+
+    An entry holds what parsing a bug's files produced, and the key of
+    those files: their paths, inodes, sizes and mtimes, or for files read
+    from an archive or mailbox, files_digest() of their contents.  There is
+    one entry per bug (by bug number and first file), so one for files
+    that have since changed is stale and is replaced when the bug is
+    parsed again.
+
+    Entries are marshal data under entries/; attachment data is kept out
+    of line in blobs/, by SHA-256, where copies are shared.  Entries and
+    blobs are touched when used, and evict() removes the least recently
+    used until the cache fits in its size limit.
+    """
+
+    version = 1
+
+    def __init__(self, path, limit):
+        self.path = path
+        self.limit = limit
+        for sub in ("entries", "blobs"):
+            try:
+                os.makedirs(os.path.join(path, sub))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def key(self, files):
+        h = hashlib.sha1("%d\n" % self.version)
+        if 'contents' in files or 'spooled' in files:
+            h.update(files.get('digest') or files_digest(files))
+            return h.hexdigest()
+        for name, st in _bug_files(files):
+            h.update("%s %d %d %r\n" % (os.path.abspath(name), st.st_ino,
+                                        st.st_size, st.st_mtime))
+        return h.hexdigest()
+
+    def entry_path(self, files):
+        name = hashlib.sha1("%d %s" % (files['number'], files['base'][0])).hexdigest()
+        return os.path.join(self.path, "entries", name[:2], name)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.path, "blobs", sha256[:2], sha256)
+
+    def lookup(self, files):
+        """The cached parse of files, if there is a current one.
+
+        This notes the key of the files in files['cache-key'], for store():
+        it must be taken before read_bug() reads the files.
+        """
+        files['cache-key'] = self.key(files)
+        path = self.entry_path(files)
+        try:
+            f = open(path, "rb")
+        except IOError:
+            return None
+        try:
+            try:
+                key, record = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                return None
+        finally:
+            f.close()
+        if key != files['cache-key']:
+            return None
+        for attachment in record[7]:
+            if not os.path.exists(self.blob_path(attachment[3])):
+                return None
+        os.utime(path, None)
+        return record
+
+    def load(self, files):
+        """Rebuild the bug parsed from files from the record lookup() found."""
+        timings = dict(files.get('timings', {}))
+        with timed(timings, 'bug'):
+            (who, reported, short_description, description, digest, notes,
+             bug_files, attachments) = files['cached']
+            current = new_bug(files, timings)
+            current['digest'] = files.get('digest') or digest
+            current['who'] = who
+            current['date-reported'] = reported
+            current['short-description'] = short_description
+            current['description'] = description
+            current['notes'] = [ Note(*n) for n in notes ]
+            current['cached'] = True
+            print "Processing: %d" % current['number']
+            for filename, mtype, size, sha256, sender in attachments:
+                blob = self.blob_path(sha256)
+                payload = Payload()
+                payload.size = size
+                payload.sha256 = sha256
+                payload.hash = None
+                if size <= attachment_spool_size:
+                    f = open(blob, "rb")
+                    payload.data = [ f.read() ]
+                    f.close()
+                else:
+                    fd, payload.path = tempfile.mkstemp(prefix="attachment.",
+                                                        dir=spool_dir)
+                    os.close(fd)
+                    os.unlink(payload.path)
+                    _clone_file(blob, payload.path)
+                os.utime(blob, None)
+                current['attachments'].append(Attachment(filename, mtype,
+                                                         payload, sender))
+        return current
+
+    def store(self, files, current):
+        """Add the parse of files to the cache."""
+        description = body_text(current['description'])
+        if not isinstance(description, str):
+            # Only plain text (and Payloads) can be kept.
+            return
+        attachments = []
         for a in current['attachments']:
-            cursor.execute( "INSERT INTO attachments SET " \
-                            "bug_id=%s, creation_ts=%s, description=%s, mimetype=%s," \
-                            "filename=%s, submitter_id=%s",
-                            [ current['number'],
-                              time.strftime("%Y-%m-%d %H:%M:%S", current['date-reported'][:9]),
-                              a[0], a[1], a[0], reporter ])
-            cursor.execute( "INSERT INTO attach_data SET " \
-                            "id=LAST_INSERT_ID(), thedata=%s",
-                            [ a[2] ])
-
-    except MySQLdb.IntegrityError, message:
-        errorcode = message[0]
-        if errorcode == 1062: # duplicate
+            blob = self.blob_path(a.payload.sha256)
+            if not os.path.exists(blob):
+                self._write_blob(blob, a.payload)
+            attachments.append((a.filename, a.mimetype, a.payload.size,
+                                a.payload.sha256, a.who))
+        record = (current['who'], current['date-reported'],
+                  current['short-description'], description,
+                  current['digest'],
+                  [ (n.text, n.who, n.when) for n in current['notes'] ],
+                  current['files'], attachments)
+        try:
+            data = marshal.dumps((files.get('cache-key') or self.key(files),
+                                  record))
+        except ValueError:
             return
+        self._write(self.entry_path(files), [ data ])
+
+    def _write_blob(self, path, payload):
+        if payload.path is not None:
+            self._mkdir(os.path.dirname(path))
+            tmp = "%s.%d.tmp" % (path, os.getpid())
+            _clone_file(payload.path, tmp)
+            os.rename(tmp, path)
         else:
-            raise
+            self._write(path, payload.chunks())
 
-    cursor.execute("COMMIT")
-    cursor.close()
-    db.close()
+    def _write(self, path, chunks):
+        """Write a file under a temporary name and rename it into place, so
+        that readers never see half of one."""
+        self._mkdir(os.path.dirname(path))
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        f = open(tmp, "wb")
+        for chunk in chunks:
+            f.write(chunk)
+        f.close()
+        os.rename(tmp, path)
 
-def usage():
-    print """Usage: jb2bz.py [OPTIONS] Product
+    def _mkdir(self, directory):
+        # Parser processes may be making the same one.
+        try:
+            os.mkdir(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
 
-Where OPTIONS are one or more of the following:
+    def evict(self):
+        """Remove the least recently used entries and blobs over limit."""
+        files = []
+        total = 0
+        for sub in ("entries", "blobs"):
+            for dirpath, dirnames, filenames in os.walk(os.path.join(self.path, sub)):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, path))
+                    total = total + st.st_size
+        files.sort()
+        removed = 0
+        for mtime, size, path in files:
+            if total <= self.limit:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total = total - size
+            removed = removed + 1
+        if removed:
+            sys.stderr.write("Removed %d files from the parse cache\n" % removed)
 
-  -h                This help information.
-  -s STATUS         One of UNCONFIRMED, CONFIRMED, IN_PROGRESS, RESOLVED, VERIFIED
-                    (default is CONFIRMED)
-  -c COMPONENT      The component to attach to each bug as it is important. This should be
-                    valid component for the Product.
-  -v VERSION        Version to assign to these defects.
+# The import's ParseCache, if parse_cache_path is set.
+parse_cache = None
 
-Product is the Product to assign these defects to.
+def parse_one(files):
+    """process_jitterbug(), or the parse cache's copy of its result."""
+    if 'cached' in files:
+        current = parse_cache.load(files)
+        if current is not None:
+            return current
+    current = _parse_one(files)
+    if parse_cache is not None:
+        with timed(current['timings'], 'cache'):
+            parse_cache.store(files, current)
+    return current
 
-All of the JitterBugs in the current directory are imported, including replies, notes,
-attachments, and similar noise.
-"""
-    sys.exit(1)
+def _parse_one(files):
+    """process_jitterbug(), under cProfile if this is profile_bug."""
+    if files['number'] != profile_bug:
+        return process_jitterbug(files)
 
+    import cProfile, pstats
+    profiler = cProfile.Profile()
+    current = profiler.runcall(process_jitterbug, files)
+    path = profile_path or "jb2bz-%d.prof" % files['number']
+    profiler.dump_stats(path)
+    sys.stderr.write("Profile of bug %d written to %s\n" % (files['number'], path))
+    pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(25)
+    return current
 
-def main():
-    global bug_status, component, version, product
-    opts, args = getopt.getopt(sys.argv[1:], "hs:c:v:")
+def parse_bug(files):
+    """parse_one() for pool workers, which must not sys.exit()."""
+    try:
+        return parse_one(files)
+    except SystemExit:
+        raise RuntimeError("bug %d could not be parsed" % files['number'])
 
-    for o,a in opts:
-        if o == "-s":
-            if a in ('UNCONFIRMED','CONFIRMED','IN_PROGRESS','RESOLVED','VERIFIED'):
-                bug_status = a
-        elif o == '-c':
-            component = a
-        elif o == '-v':
-            version = a
-        elif o == '-h':
-            usage()
+def _init_parser():
+    # Leave ^C to the parent, which tears the pool down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-    if len(args) != 1:
-        sys.stderr.write("Must specify the Product.\n")
-        sys.exit(1)
+def parsed_bugs(bugs):
+    """Yield the parsed bugs for index_directory() entries, in the order given.
+
+    With jobs > 1 the MIME parsing is spread over a process pool.  Only a
+    bounded window of bugs is in flight, and results are handed back in
+    submission order so that the writer still inserts in bug_id order.
+    """
+    if jobs <= 1:
+        for files in bugs:
+            current = parse_one(files)
+            if budget is not None:
+                budget.release(files)
+            yield current
+        return
+
+    pool = multiprocessing.Pool(jobs, _init_parser)
+    try:
+        bugs = iter(bugs)
+        pending = collections.deque()
+        for files in itertools.islice(bugs, jobs * 8):
+            pending.append((files, pool.apply_async(parse_bug, (files,))))
+        while pending:
+            files, result = pending.popleft()
+            current = result.get()
+            if budget is not None:
+                # What was read ahead for it is gone with the worker's copy.
+                budget.release(files)
+            for files in itertools.islice(bugs, 1):
+                pending.append((files, pool.apply_async(parse_bug, (files,))))
+            yield current
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+class PipelineError(Exception):
+    """Another stage of the pipeline failed."""
+
+# Marks the end of a pipeline queue.
+_end = object()
+
+def _put(queue, item, failures):
+    """queue.put() that gives up once another stage has failed."""
+    while True:
+        if failures:
+            raise PipelineError()
+        try:
+            queue.put(item, True, 0.5)
+            return
+        except Queue.Full:
+            pass
+
+def _drain(queue, failures):
+    """Yield the items put on queue until the end marker."""
+    while True:
+        if failures:
+            raise PipelineError()
+        try:
+            item = queue.get(True, 0.5)
+        except Queue.Empty:
+            continue
+        if item is _end:
+            return
+        yield item
+
+def _stage(target, failures, *args):
+    """Start a thread running target(*args), recording it in failures if it fails."""
+    def run():
+        try:
+            target(*args)
+        except PipelineError:
+            pass
+        except:
+            failures.append(sys.exc_info())
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def _read_stage(bugs, queue, failures):
+    for files in bugs:
+        _put(queue, read_bug(files), failures)
+    _put(queue, _end, failures)
+
+def _write_stage(queue, writer, stats, failures):
+    for current in _drain(queue, failures):
+        stats.bug_done(current)
+        with timed(stats.stages, 'write'):
+            writer.add(current)
+
+def run_pipeline(bugs, writer, stats):
+    """Read, parse and write bugs in overlapping stages.
+
+    A reader thread loads the files of the bugs ahead of the parser (which
+    may be a process pool, see parsed_bugs()), and a writer thread hands
+    parsed bugs to the writer; so disk reads for later bugs overlap with
+    database writes for earlier ones.  The stages are connected by queues
+    of read_ahead and write_queue_size bugs; a stage that gets ahead blocks
+    until there's room, which keeps memory bounded.  If any stage fails,
+    the others stop and the first failure is raised here.
+    """
+    failures = []
+    read_queue = Queue.Queue(read_ahead)
+    write_queue = Queue.Queue(write_queue_size)
+    reader = _stage(_read_stage, failures, bugs, read_queue, failures)
+    writer_thread = _stage(_write_stage, failures, write_queue, writer, stats,
+                           failures)
+    try:
+        try:
+            for current in parsed_bugs(_drain(read_queue, failures)):
+                if budget is not None:
+                    budget.admit(current)
+                _put(write_queue, current, failures)
+            _put(write_queue, _end, failures)
+            while writer_thread.is_alive():
+                writer_thread.join(0.5)
+        except PipelineError:
+            pass
+        except:
+            failures.append(sys.exc_info())
+    finally:
+        # Any failure recorded above stops the other stages; wait for them.
+        reader.join()
+        writer_thread.join()
+
+    if failures:
+        raise failures[0][0], failures[0][1], failures[0][2]
+
+class Journal:
+    """An append-only record of the bugs that have been imported.
+
+    Each line holds a bug number, the files_signature() and the
+    files_digest() of the files it was imported from, and for imports into
+    a database, the content_digest() of the rows written for it.  Lines are
+    only written once the bug's batch has been committed, and the last line
+    for a bug wins.
+    """
+
+    def __init__(self, path):
+        self.entries = {}
+        self.contents = {}
+        if os.path.exists(path):
+            f = open(path, "r")
+            for line in f:
+                fields = line.split()
+                if len(fields) in (3, 4) and fields[0].isdigit():
+                    number = int(fields[0])
+                    self.entries[number] = (fields[1], fields[2])
+                    if len(fields) == 4:
+                        self.contents[number] = fields[3]
+                    else:
+                        self.contents.pop(number, None)
+            f.close()
+        self.f = open(path, "a")
+
+    def get(self, number):
+        return self.entries.get(number)
+
+    def record(self, number, signature, digest, content=None):
+        self.entries[number] = (signature, digest)
+        if content is None:
+            self.contents.pop(number, None)
+            self.f.write("%d %s %s\n" % (number, signature, digest))
+        else:
+            self.contents[number] = content
+            self.f.write("%d %s %s %s\n" % (number, signature, digest, content))
+
+    def record_bugs(self, bugs):
+        for current in bugs:
+            self.record(current['number'], current['signature'], current['digest'],
+                        current.get('content-digest'))
+        self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.sync()
+        self.f.close()
+
+class AttachmentIndex:
+    """An append-only record of the attachments that have been stored.
+
+    Each line holds the SHA-256 of an attachment's contents, its attach_id
+    and its bug_id.  Like the Journal, lines are only written once the batch
+    has been committed, and the last line for a hash wins; a line with
+    attach_id 0 forgets the hash.
+    """
+
+    def __init__(self, path):
+        self.entries = {}
+        if os.path.exists(path):
+            f = open(path, "r")
+            for line in f:
+                fields = line.split()
+                if len(fields) == 3 and fields[1].isdigit() and fields[2].isdigit():
+                    if fields[1] == "0":
+                        self.entries.pop(fields[0], None)
+                    else:
+                        self.entries[fields[0]] = (int(fields[1]), int(fields[2]))
+            f.close()
+        self.f = open(path, "a")
+
+    def get(self, sha256):
+        return self.entries.get(sha256)
+
+    def discard_bugs(self, numbers):
+        """Forget the attachments of bugs whose rows have been replaced."""
+        numbers = set(numbers)
+        for sha256, entry in self.entries.items():
+            if entry[1] in numbers:
+                self.forget(sha256)
+
+    def forget(self, sha256):
+        del self.entries[sha256]
+        self.f.write("%s 0 0\n" % sha256)
+
+    def record(self, sha256, attach_id, bug_id):
+        self.entries[sha256] = (attach_id, bug_id)
+        self.f.write("%s %d %d\n" % (sha256, attach_id, bug_id))
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.sync()
+        self.f.close()
+
+def content_digest(comments, attachments):
+    """A digest of what a bug holds in the database, from the SHA-256 of
+    each of its comments and attachments in the order they were stored.
+
+    The importer records it in the journal, and verify_import() computes it
+    again from hashes the database makes of its rows.
+    """
+    h = hashlib.sha256()
+    for sha256 in comments:
+        h.update("c %s\n" % sha256)
+    for sha256 in attachments:
+        h.update("a %s\n" % sha256)
+    return h.hexdigest()
+
+def verify_import(writer, journal):
+    """Check the bugs the journal has a content_digest() for against the
+    database, and report those that are missing or differ.
+
+    The bugs are checked in ranges of verify_range, by verify_jobs threads
+    with a connection each; the database does the hashing, so only digests
+    are sent back.  Returns the numbers of the bugs reported.
+    """
+    started = time.time()
+    numbers = sorted(journal.contents)
+    ranges = Queue.Queue()
+    for i in xrange(0, len(numbers), verify_range):
+        ranges.put(numbers[i:i + verify_range])
+    missing = []
+    differ = []
+    failures = []
+
+    def run():
+        try:
+            db = writer.connect()
+            try:
+                while True:
+                    try:
+                        chunk = ranges.get_nowait()
+                    except Queue.Empty:
+                        return
+                    found = writer.content_digests(db, chunk[0], chunk[-1])
+                    for number in chunk:
+                        if number not in found:
+                            missing.append(number)
+                        elif found[number] != journal.contents[number]:
+                            differ.append(number)
+            finally:
+                db.close()
+        except:
+            failures.append(sys.exc_info())
+
+    threads = [ threading.Thread(target=run)
+                for i in range(min(verify_jobs, ranges.qsize())) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if failures:
+        raise failures[0][0], failures[0][1], failures[0][2]
+
+    for number in sorted(missing):
+        print "Bug %d is missing" % number
+    for number in sorted(differ):
+        print "Bug %d differs from what was imported" % number
+    sys.stderr.write("Verified %d bugs in %.1f seconds: %d missing, %d differ\n"
+                     % (len(numbers), time.time() - started, len(missing),
+                        len(differ)))
+    unrecorded = len(journal.entries) - len(numbers)
+    if unrecorded:
+        sys.stderr.write("%d bugs in the journal have no digest to check\n"
+                         % unrecorded)
+    return sorted(missing + differ)
+
+def select_bugs(index, existing, journal):
+    """Pick the index_directory() entries that need to be imported.
+
+    Bugs that aren't in the database yet are always imported.  Bugs that
+    are in it are skipped, unless the journal knows which files they were
+    imported from and those have changed since: those are imported again,
+    replacing what is there.  Only bugs whose stat results differ from the
+    journal's are read to compare their contents.
+    """
+    selected = []
+    for number in sorted(index):
+        files = index[number]
+        if number in existing:
+            entry = journal and journal.get(number)
+            if not entry:
+                continue
+            signature = files_signature(files)
+            if signature == entry[0]:
+                continue
+            digest = files_digest(files)
+            if digest == entry[1]:
+                # Touched but not changed; remember the new stat results.
+                journal.record(number, signature, digest,
+                               journal.contents.get(number))
+                continue
+            files['replace'] = True
+            files['digest'] = digest
+        selected.append(files)
+    return selected
+
+class Source:
+    """Where the bugs to import come from.
+
+    A source turns whatever it reads into the records index_directory()
+    makes: a bug's 'number' and 'settings', (name, stat) pairs for the
+    message it was reported with ('base'), its 'notes' and its 'reply' and
+    'followup' messages, and optionally the 'contents' of all of those by
+    name, or where they are in a spool file ('spooled').  Everything from there on, from parsing the messages into a
+    description, notes and attachments to writing them, is the same for
+    every source.
+    """
+
+    def names(self):
+        """The (product, component, version) triples known up front."""
+        return []
 
-    product = args[0]
+    def bugs(self, existing, journal, stats):
+        """The records of the bugs to import; see select_bugs()."""
+        raise NotImplementedError
+
+class DirectorySource(Source):
+    """JitterBug directories, given as (path, settings) pairs."""
+
+    def __init__(self, directories):
+        self.directories = directories
+
+    def names(self):
+        return [ (settings['product'], settings['component'], settings['version'])
+                 for path, settings in self.directories ]
+
+    def bugs(self, existing, journal, stats):
+        with timed(stats.stages, 'index'):
+            index = index_tree(self.directories)
+        with timed(stats.stages, 'select'):
+            bugs = select_bugs(index, existing, journal)
+        sys.stderr.write("%d bugs found, %d to import\n" % (len(index), len(bugs)))
+        stats.selected(bugs)
+        return bugs
+
+class ArchiveSource(Source):
+    """JitterBug directories in an archive; see index_archive()."""
+
+    def __init__(self, path, settings_for):
+        self.path = path
+        self.settings_for = settings_for
+
+    def bugs(self, existing, journal, stats):
+        # Bugs are selected as the archive is read.
+        seen = {}
+        for directory, index in index_archive(self.path, self.settings_for):
+            for number in sorted(index):
+                if number in seen:
+                    sys.stderr.write("Bug %d is in both %s and %s; importing the first\n"
+                                     % (number, seen[number], directory))
+                    del index[number]
+                else:
+                    seen[number] = directory
+            for files in select_bugs(index, existing, journal):
+                yield files
+
+def _message_ids(value):
+    return re.findall(r"<([^<>\s]+)>", value or "")
+
+class MailSource(Source):
+    """Threads of messages in an mbox file or a Maildir, as bugs.
+
+    Each thread becomes a bug: its first message is the report and the
+    rest are its replies.  Messages are threaded by Message-ID and
+    In-Reply-To (or the last of References), so a thread's messages can
+    be anywhere in the mailbox.
+
+    The mailbox is read twice.  The first pass only reads headers, and
+    records where each message is and what it replies to in a SQLite
+    index on disk, which then works out each thread's first message.
+    The second pass reads the messages a thread at a time.  Neither keeps
+    more than one thread in memory, however big the mailbox.
+    """
+
+    def __init__(self, path, settings, first_bug, index_path):
+        self.path = path
+        self.settings = settings
+        self.first_bug = first_bug
+        self.index_path = index_path
+        self.maildir = os.path.isdir(path)
+
+    def names(self):
+        s = self.settings
+        return [ (s['product'], s['component'], s['version']) ]
+
+    def _mbox_messages(self):
+        """Yield (offset, length, headers) for each message of the mbox."""
+        f = open(self.path, "rb")
+        try:
+            offset = 0
+            start = None
+            headers = None
+            # The length of the last line if it was blank: the blank line
+            # before a "From " line separates messages.
+            blank = 1
+            for line in f:
+                if line.startswith("From ") and blank:
+                    if start is not None:
+                        yield start, offset - blank - start, "".join(headers)
+                    start = offset + len(line)
+                    headers = []
+                elif headers is not None and (not headers
+                                              or headers[-1] not in ("\n", "\r\n")):
+                    headers.append(line)
+                blank = line in ("\n", "\r\n") and len(line)
+                offset = offset + len(line)
+            if start is not None:
+                yield start, offset - blank - start, "".join(headers)
+        finally:
+            f.close()
+
+    def _maildir_messages(self):
+        """Yield (filename, size, headers) for each message of the Maildir."""
+        for sub in ("cur", "new"):
+            directory = os.path.join(self.path, sub)
+            if not os.path.isdir(directory):
+                continue
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                f = open(path, "rb")
+                try:
+                    headers = []
+                    for line in f:
+                        headers.append(line)
+                        if line in ("\n", "\r\n"):
+                            break
+                finally:
+                    f.close()
+                yield path, os.path.getsize(path), "".join(headers)
+
+    def build_index(self):
+        """The first pass: index the messages and find their threads."""
+        db = sqlite3.connect(self.index_path)
+        db.text_factory = str
+        db.execute("CREATE TABLE messages (seq integer PRIMARY KEY," \
+                   " message_id text, parent text, location text," \
+                   " offset integer, length integer, mtime real, root integer)")
+        if self.maildir:
+            messages = ((path, 0, length, headers)
+                        for path, length, headers in self._maildir_messages())
+        else:
+            messages = ((self.path, offset, length, headers)
+                        for offset, length, headers in self._mbox_messages())
+        parser = email.parser.HeaderParser()
+        rows = []
+        for location, offset, length, headers in messages:
+            msg = parser.parsestr(headers)
+            ids = _message_ids(msg['Message-ID'])
+            parents = (_message_ids(msg['In-Reply-To'])
+                       or _message_ids(msg['References'])[-1:])
+            mtime = 0
+            date = email.utils.parsedate_tz(msg['Date'] or "")
+            if date is not None:
+                mtime = email.utils.mktime_tz(date)
+            rows.append((ids and ids[0] or None, parents and parents[0] or None,
+                         location, offset, length, mtime))
+            if len(rows) >= 10000:
+                db.executemany("INSERT INTO messages (message_id, parent, location," \
+                               " offset, length, mtime) VALUES (?, ?, ?, ?, ?, ?)", rows)
+                rows = []
+        db.executemany("INSERT INTO messages (message_id, parent, location," \
+                       " offset, length, mtime) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        db.execute("CREATE INDEX messages_message_id ON messages (message_id)")
+
+        # A message starts a thread unless it replies to one that is here.
+        # The others take their parent's thread, a generation per UPDATE;
+        # whatever is left is in a loop of replies and starts its own.
+        db.execute("UPDATE messages SET root = seq WHERE parent IS NULL" \
+                   " OR parent NOT IN (SELECT message_id FROM messages" \
+                   " WHERE message_id IS NOT NULL)")
+        while True:
+            updated = db.execute("UPDATE messages SET root =" \
+                   " (SELECT MIN(p.root) FROM messages p" \
+                   "  WHERE p.message_id = messages.parent)" \
+                   " WHERE root IS NULL AND EXISTS (SELECT 1 FROM messages p" \
+                   "  WHERE p.message_id = messages.parent AND p.root IS NOT NULL)")
+            if updated.rowcount <= 0:
+                break
+        db.execute("UPDATE messages SET root = seq WHERE root IS NULL")
+        db.execute("CREATE INDEX messages_root ON messages (root, seq)")
+        db.commit()
+        return db
+
+    def _read(self, f, location, offset, length):
+        if self.maildir:
+            f = open(location, "rb")
+            try:
+                return f.read()
+            finally:
+                f.close()
+        f.seek(offset)
+        # Undo mboxrd's quoting of lines starting with "From ".
+        return re.sub(r"(?m)^>(>*From )", r"\1", f.read(length))
+
+    def bugs(self, existing, journal, stats):
+        with timed(stats.stages, 'index'):
+            db = self.build_index()
+        f = None
+        if not self.maildir:
+            f = open(self.path, "rb")
+        try:
+            threads = db.execute("SELECT seq FROM messages WHERE root = seq" \
+                                 " ORDER BY seq")
+            for number, (root,) in enumerate(threads, self.first_bug):
+                files = {'number': number, 'base': None, 'notes': None,
+                         'reply': [], 'followup': [], 'settings': self.settings,
+                         'contents': {}}
+                # The message that started the thread first, then the others
+                # by date.
+                for seq, location, offset, length, mtime in db.execute(
+                        "SELECT seq, location, offset, length, mtime" \
+                        " FROM messages WHERE root = ?" \
+                        " ORDER BY seq != root, mtime, seq",
+                        [ root ]):
+                    name = "%s:%d" % (location, offset)
+                    files['contents'][name] = self._read(f, location, offset, length)
+                    member = (name, MemberStat(length, mtime))
+                    if seq == root:
+                        files['base'] = member
+                    else:
+                        files['reply'].append(member)
+                for files in select_bugs({ number: files }, existing, journal):
+                    yield files
+        finally:
+            if f is not None:
+                f.close()
+            db.close()
+
+class Lookups:
+    """Product, component, version and user IDs, read in bulk at startup.
+
+    The tables are small next to the bugs being imported, so they are read
+    whole once and every bug, note and attachment is resolved from memory.
+    Names are matched without regard to case, as MySQL compares them.
+    """
+
+    def __init__(self):
+        self.products = {}      # name -> id
+        self.components = {}    # (product id, name) -> id
+        self.versions = set()   # (product id, value)
+        self.users = {}         # login_name -> userid
+
+    def product_id(self, name):
+        try:
+            return self.products[name.lower()]
+        except KeyError:
+            raise LookupError("There is no product named '%s'." % name)
+
+    def component_id(self, product_name, name):
+        try:
+            return self.components[(self.product_id(product_name), name.lower())]
+        except KeyError:
+            raise LookupError("Product '%s' has no component named '%s'."
+                              % (product_name, name))
+
+    def check_version(self, product_name, value):
+        if (self.product_id(product_name), value.lower()) not in self.versions:
+            raise LookupError("Product '%s' has no version '%s'."
+                              % (product_name, value))
+
+    def user_id(self, who):
+        """The userid of a message_sender(), or reporter if it has none."""
+        if who is None:
+            return reporter
+        return self.users.get(who[1].lower(), reporter)
+
+class LagProbe:
+    """Measures how far the database's replicas are behind."""
+
+    def lag(self):
+        """The replica lag in seconds, or None if it can't be measured."""
+        raise NotImplementedError
+
+class CommandLagProbe(LagProbe):
+    """Runs a shell command that prints the lag in seconds, such as
+    pt-heartbeat --check."""
+
+    def __init__(self, command):
+        self.command = command
+
+    def lag(self):
+        try:
+            output = subprocess.check_output(self.command, shell=True)
+            return float(output.split()[0])
+        except (OSError, subprocess.CalledProcessError, ValueError, IndexError), e:
+            sys.stderr.write("Replica lag command failed: %s\n" % e)
+            return None
+
+class MySQLReplicaLagProbe(LagProbe):
+    """Asks a MySQL replica for Seconds_Behind_Master.
+
+    The replica is reached with the same user and password as the
+    database.  A replica that isn't replicating has no lag to report.
+    """
+
+    def __init__(self, host):
+        self.params = dict([ (key, value) for key, value in db_params.items()
+                             if value is not None and key != 'port' ])
+        if ':' in host:
+            host, port = host.rsplit(':', 1)
+            self.params['port'] = int(port)
+        self.params['host'] = host
+        self.db = None
+
+    def lag(self):
+        try:
+            if self.db is None:
+                self.db = MySQLdb.connect(**self.params)
+            cursor = self.db.cursor()
+            cursor.execute("SHOW SLAVE STATUS")
+            row = cursor.fetchone()
+            names = [ d[0] for d in cursor.description or () ]
+            cursor.close()
+        except MySQLdb.Error, e:
+            sys.stderr.write("Can't read replica lag: %s\n" % e)
+            self.db = None
+            return None
+        if row is None or 'Seconds_Behind_Master' not in names:
+            return None
+        lag = row[names.index('Seconds_Behind_Master')]
+        if lag is None:
+            return None
+        return float(lag)
+
+class Throttle:
+    """Paces a BugWriter so that it doesn't swamp a database in use.
+
+    After every batch, the time its transaction took is compared with
+    target.  Over the target, the batch size is halved and the pause
+    between batches doubled.  Under it the pause halves, and well under
+    it batches also grow by a tenth of max_batch (additive increase,
+    multiplicative decrease, so load is shed fast and taken on slowly).  While probe
+    reports more than max_lag seconds of replica lag, or can't tell, writes
+    stop altogether; after max_failed_probes failures in a row the import
+    is stopped rather than left waiting on a probe that may never work.
+
+    Every change is kept in decisions, for the stats file.
+    """
+
+    max_delay = 30.0
+    probe_interval = 1.0
+    max_failed_probes = 60
+    kept_decisions = 1000
+
+    def __init__(self, target, max_batch, probe=None, max_lag=None):
+        self.target = target
+        self.max_batch = max_batch
+        self.batch = max_batch
+        self.delay = 0.0
+        self.probe = probe
+        self.max_lag = max_lag
+        self.started = time.time()
+        self.last_probe = None
+        self.lag = None
+        self.batches = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.paused = 0.0
+        self.decision_count = 0
+        self.decisions = collections.deque(maxlen=self.kept_decisions)
+
+    def decide(self, action, latency):
+        self.decision_count = self.decision_count + 1
+        self.decisions.append({'at': round(time.time() - self.started, 3),
+                               'action': action,
+                               'latency': round(latency, 6), 'lag': self.lag,
+                               'batch': self.batch,
+                               'delay': round(self.delay, 3)})
+
+    def committed(self, latency):
+        """Note how long a batch took, and wait as long as is called for."""
+        self.batches = self.batches + 1
+        self.latency_total = self.latency_total + latency
+        self.latency_max = max(self.latency_max, latency)
+        if latency > self.target:
+            batch = max(1, self.batch // 2)
+            delay = min(self.max_delay, max(2 * self.delay, self.target / 10))
+            action = 'slower'
+        else:
+            batch = self.batch
+            if latency < self.target / 2:
+                batch = min(self.max_batch, batch + max(1, self.max_batch // 10))
+            delay = self.delay / 2
+            if delay < 0.01:
+                delay = 0.0
+            action = 'faster'
+        if (batch, delay) != (self.batch, self.delay):
+            self.batch, self.delay = batch, delay
+            self.decide(action, latency)
+        if self.delay:
+            time.sleep(self.delay)
+        self.wait_for_replicas(latency)
+
+    def wait_for_replicas(self, latency):
+        if self.probe is None:
+            return
+        now = time.time()
+        if self.last_probe is not None and now - self.last_probe < self.probe_interval:
+            return
+        self.last_probe = now
+        self.lag = self.probe.lag()
+        if self.lag is not None and self.lag <= self.max_lag:
+            return
+        if self.lag is None:
+            sys.stderr.write("Replica lag is unknown; pausing\n")
+        else:
+            sys.stderr.write("Replica lag of %.1fs is over %.1fs; pausing\n"
+                             % (self.lag, self.max_lag))
+        self.batch = max(1, self.batch // 2)
+        self.decide('pause', latency)
+        failed = 0
+        while self.lag is None or self.lag > self.max_lag:
+            if self.lag is None:
+                failed = failed + 1
+                if failed >= self.max_failed_probes:
+                    raise RuntimeError("Replica lag couldn't be measured %d times"
+                                       " in a row; stopping" % failed)
+            else:
+                failed = 0
+            time.sleep(self.probe_interval)
+            self.lag = self.probe.lag()
+        self.paused = self.paused + time.time() - now
+        self.last_probe = time.time()
+        self.decide('resume', latency)
+
+    def summary(self):
+        return {'target': self.target, 'max_lag': self.max_lag,
+                'batches': self.batches,
+                'latency_mean': round(self.latency_total / max(self.batches, 1), 6),
+                'latency_max': round(self.latency_max, 6),
+                'paused': round(self.paused, 3),
+                'batch': self.batch, 'delay': round(self.delay, 3),
+                'decision_count': self.decision_count,
+                'decisions': list(self.decisions)}
+
+class BugWriter:
+    """Writes bugs over one connection, committing them in batches.
+
+    Bugs are queued until the batch holds commit_every bugs or is older than
+    commit_interval seconds, and are then written with insert_bugs() and
+    committed together.  If anything in a batch fails, only that batch is
+    rolled back; its bugs are then retried one transaction at a time so that
+    a single bad bug doesn't take the rest of the batch with it.
+
+    Attachment IDs are allocated here rather than by AUTO_INCREMENT.  With
+    a throttle, for a Bugzilla in use, they come from blocks set aside by
+    reserve_attach_ids(), so that attachments added meanwhile don't take
+    them; otherwise nothing else should be adding attachments.
+
+    With a throttle, batches are as big as it says rather than
+    commit_every, and it gets to pause the writer after each.
+
+    This class holds everything that doesn't depend on the database;
+    subclasses provide connect() and Error, and whatever SQL differs.
+    Exporter implements the same interface without a database.
+    """
+
+    Error = None
+
+    def __init__(self, commit_every, commit_interval, journal=None):
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.journal = journal
+        self.db = None
+        self.next_attach_id = None
+        self.pending = []
+        self.started = None
+        self.failed = []
+        self.statements = 0
+        self.lookups = Lookups()
+        self.checked = set()
+        self.new_users = []
+        self.attachment_index = None
+        self.duplicates = 0
+        self.throttle = None
+        self.attach_ids = None
+        self.attach_ids_end = None
+
+    def connect(self):
+        """Open a new connection, with autocommit off."""
+        raise NotImplementedError
+
+    def is_duplicate(self, error):
+        """Whether error is a duplicate key error."""
+        raise NotImplementedError
+
+    def is_disconnect(self, error):
+        """Whether error means the connection can't be used any more."""
+        return False
+
+    def blob(self, data):
+        """Wrap data for binding to a BLOB column."""
+        return data
+
+    def index_names(self, cursor, table):
+        """The names of the indexes on table."""
+        raise NotImplementedError
+
+    def drop_index_sql(self, table, name):
+        return "DROP INDEX %s ON %s" % (name, table)
+
+    def fulltext_index_sql(self, table, name, column):
+        return "CREATE FULLTEXT INDEX %s ON %s (%s)" % (name, table, column)
+
+    def sent_bytes_sql(self, db, column):
+        """SQL for the bytes of text column as they were sent over db, which
+        is what the importer hashed: the server stores text in the column's
+        character set, and converts from and to the connection's."""
+        return "CONVERT(%s USING %s)" % (column, db.character_set_name())
+
+    def execute(self, cursor, sql, args=()):
+        self.statements = self.statements + 1
+        cursor.execute(sql, args)
+
+    def executemany(self, cursor, sql, rows):
+        self.statements = self.statements + 1
+        cursor.executemany(sql, rows)
+
+    def _connection(self):
+        if self.db is None:
+            self.db = self.connect()
+        return self.db
+
+    def _drop_connection(self):
+        """Close a connection that is no longer usable."""
+        if self.db is not None:
+            try:
+                self.db.close()
+            except Exception:
+                pass
+            self.db = None
+
+    def bug_exists(self, number):
+        """Whether bug number is in the database."""
+        db = self._connection()
+        cursor = db.cursor()
+        try:
+            self.execute(cursor, "SELECT 1 FROM bugs WHERE bug_id = %s", [ number ])
+            found = cursor.fetchone() is not None
+        finally:
+            cursor.close()
+        db.commit()
+        return found
+
+    def existing_bug_ids(self):
+        """The set of bug IDs already in the database, in one query."""
+        cursor = self._connection().cursor()
+        try:
+            self.execute(cursor, "SELECT bug_id FROM bugs")
+            return set([ int(row[0]) for row in cursor.fetchall() ])
+        finally:
+            cursor.close()
+
+    def content_digests(self, db, first, last):
+        """content_digest() of the bugs from first to last that are in the
+        database, with their rows hashed by SHA2() on db."""
+        comments = {}
+        attachments = {}
+        cursor = db.cursor()
+        try:
+            self.execute(cursor, "SELECT bug_id FROM bugs" \
+                         " WHERE bug_id BETWEEN %s AND %s", [ first, last ])
+            present = [ int(row[0]) for row in cursor.fetchall() ]
+            self.execute(cursor, "SELECT bug_id, SHA2(%s, 256) FROM longdescs" \
+                         " WHERE bug_id BETWEEN %%s AND %%s" \
+                         " ORDER BY bug_id, comment_id"
+                         % self.sent_bytes_sql(db, "thetext"), [ first, last ])
+            for bug_id, sha256 in cursor.fetchall():
+                comments.setdefault(int(bug_id), []).append(sha256)
+            self.execute(cursor, "SELECT a.bug_id, a.attach_id," \
+                         " SHA2(d.thedata, 256), LENGTH(d.thedata)" \
+                         " FROM attachments a LEFT JOIN attach_data d" \
+                         " ON d.id = a.attach_id" \
+                         " WHERE a.bug_id BETWEEN %s AND %s" \
+                         " ORDER BY a.bug_id, a.attach_id", [ first, last ])
+            for bug_id, attach_id, sha256, length in cursor.fetchall():
+                if length == 0 and attachdir is not None:
+                    # Stored in the local attachment store, if anywhere.
+                    path = local_attachment_path(int(attach_id))
+                    if os.path.exists(path):
+                        h = hashlib.sha256()
+                        f = open(path, "rb")
+                        for chunk in iter(lambda: f.read(attachment_chunk_size), ""):
+                            h.update(chunk)
+                        f.close()
+                        sha256 = h.hexdigest()
+                attachments.setdefault(int(bug_id), []).append(sha256)
+        finally:
+            cursor.close()
+        return dict([ (number, content_digest(comments.get(number, []),
+                                              attachments.get(number, [])))
+                      for number in present ])
+
+    def load_lookups(self, names):
+        """Read the products, components, versions and profiles tables.
+
+        names lists the (product, component, version) triples that bugs
+        will be filed under, as far as they are known before the import;
+        see check_names().
+        """
+        self.read_lookups()
+        self.check_names(names)
+
+    def read_lookups(self):
+        cursor = self._connection().cursor()
+        try:
+            lookups = self.lookups
+            self.execute(cursor, "SELECT id, name FROM products")
+            for id, name in cursor.fetchall():
+                lookups.products[name.lower()] = int(id)
+            self.execute(cursor, "SELECT id, product_id, name FROM components")
+            for id, product_id, name in cursor.fetchall():
+                lookups.components[(int(product_id), name.lower())] = int(id)
+            self.execute(cursor, "SELECT product_id, value FROM versions")
+            for product_id, value in cursor.fetchall():
+                lookups.versions.add((int(product_id), value.lower()))
+            self.execute(cursor, "SELECT userid, login_name FROM profiles")
+            for userid, login_name in cursor.fetchall():
+                lookups.users[login_name.lower()] = int(userid)
+        finally:
+            cursor.close()
+
+    def check_names(self, names):
+        """Raise LookupError unless each (product, component, version) exists.
+
+        add() checks the names of each bug it is given too, for sources
+        whose names only turn up as they are read.
+        """
+        for triple in names:
+            if triple in self.checked:
+                continue
+            product_name, component_name, value = triple
+            self.lookups.component_id(product_name, component_name)
+            self.lookups.check_version(product_name, value)
+            self.checked.add(triple)
+
+    def schema_objects(self, cursor, tables):
+        """The secondary indexes and foreign keys of tables.
+
+        Each is a list of [table, kind, name, definition], where kind is
+        'index' or 'foreign key' and definition is what create_objects()
+        needs to make it again.
+        """
+        raise NotImplementedError
+
+    def drop_objects(self, cursor, objects):
+        raise NotImplementedError
+
+    def create_objects(self, cursor, objects):
+        raise NotImplementedError
+
+    def check_constraints(self, cursor, tables):
+        """Check the rows of tables against constraints that were off."""
+        pass
+
+    def prepare(self):
+        """Get the database ready for the import.
+
+        A bulk load that didn't finish is finished first, so nothing is
+        imported into a half-restored schema.  Then see bulk_load and
+        defer_fulltext.  The attachment index is checked against the
+        database first.
+        """
+        if self.attachment_index is not None:
+            self.check_attachment_index()
+        if os.path.exists(bulk_state_path):
+            sys.stderr.write("Restoring the schema from an unfinished bulk load"
+                             " (%s)\n" % bulk_state_path)
+            self.finish_bulk_load()
+        if bulk_load:
+            self.start_bulk_load()
+        if not defer_fulltext:
+            return
+        cursor = self._connection().cursor()
+        try:
+            existing = self.index_names(cursor, "bugs_fulltext")
+            for name, column in fulltext_indexes:
+                if name in existing:
+                    self.execute(cursor, self.drop_index_sql("bugs_fulltext", name))
+        finally:
+            cursor.close()
+        self._connection().commit()
+
+    def start_bulk_load(self):
+        """Drop the secondary indexes and foreign keys of bulk_tables.
+
+        They are written to bulk_state_path first, and that file is only
+        removed once finish_bulk_load() has put them back and checked them,
+        so a crash at any point leaves what is needed to recover.
+        """
+        db = self._connection()
+        cursor = db.cursor()
+        try:
+            objects = self.schema_objects(cursor, bulk_tables)
+            f = open(bulk_state_path + ".tmp", "w")
+            json.dump({ 'tables': bulk_tables, 'objects': objects }, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.rename(bulk_state_path + ".tmp", bulk_state_path)
+            self.drop_objects(cursor, objects)
+        finally:
+            cursor.close()
+        db.commit()
+
+    def finish_bulk_load(self):
+        """Restore what start_bulk_load() dropped, and verify the result."""
+        if not os.path.exists(bulk_state_path):
+            return
+        f = open(bulk_state_path)
+        state = json.load(f)
+        f.close()
+        tables = [ str(table) for table in state['tables'] ]
+        objects = [ map(str, o) for o in state['objects'] ]
+        db = self._connection()
+        cursor = db.cursor()
+        try:
+            missing = self._missing_objects(cursor, tables, objects)
+            if missing:
+                sys.stderr.write("Rebuilding %d indexes and foreign keys\n"
+                                 % len(missing))
+                self.create_objects(cursor, missing)
+            missing = self._missing_objects(cursor, tables, objects)
+            if missing:
+                raise RuntimeError("%s could not be restored; see %s"
+                                   % (", ".join([ o[2] for o in missing ]),
+                                      bulk_state_path))
+            self.check_constraints(cursor, tables)
+        finally:
+            cursor.close()
+        db.commit()
+        os.unlink(bulk_state_path)
+
+    def _missing_objects(self, cursor, tables, objects):
+        existing = set([ tuple(o[:3]) for o in self.schema_objects(cursor, tables) ])
+        return [ o for o in objects if tuple(o[:3]) not in existing ]
+
+    def restore_fulltext(self):
+        """Build the full-text indexes that prepare() dropped.
+
+        Whichever are missing are created, so a run that died before it got
+        here is repaired by the next one.
+        """
+        cursor = self._connection().cursor()
+        try:
+            existing = self.index_names(cursor, "bugs_fulltext")
+            for name, column in fulltext_indexes:
+                if name not in existing:
+                    sys.stderr.write("Building index %s\n" % name)
+                    self.execute(cursor, self.fulltext_index_sql("bugs_fulltext",
+                                                                 name, column))
+        finally:
+            cursor.close()
+        self._connection().commit()
+
+    def create_users(self, cursor, bugs):
+        """Create profiles for the senders in bugs that don't have one.
+
+        The new profiles can't log in until a password is set.  They are
+        added to the lookups right away and listed in new_users, so that
+        they can be forgotten again if the transaction is rolled back.
+        """
+        senders = {}
+        for current in bugs:
+            whos = [ current['who'] ]
+            whos.extend([ n.who for n in current['notes'] ])
+            whos.extend([ a.who for a in current['attachments'] ])
+            for who in whos:
+                if who is not None and who[1].lower() not in self.lookups.users:
+                    senders.setdefault(who[1].lower(), who)
+        if not senders:
+            return
+        logins = sorted(senders.keys())
+        rows = [ [ senders[login][1][:255], senders[login][0][:255], '*' ]
+                 for login in logins ]
+        self.insert_table(cursor, "profiles",
+                          ("login_name", "realname", "cryptpassword"),
+                          rows, [ len(r[0]) + len(r[1]) + 32 for r in rows ])
+        self.execute(cursor, "SELECT userid, login_name FROM profiles" \
+                     " WHERE login_name IN (%s)" % ", ".join(["%s"] * len(logins)),
+                     [ senders[login][1][:255] for login in logins ])
+        for userid, login_name in cursor.fetchall():
+            self.lookups.users[login_name.lower()] = int(userid)
+            self.new_users.append(login_name.lower())
+
+    def insert_rows(self, cursor, sql, rows, sizes):
+        """executemany() rows in chunks of at most max_statement_bytes.
+
+        MySQLdb turns executemany() of an INSERT ... VALUES into multi-row
+        statements, so there each chunk costs a single round trip.
+        """
+        chunk = []
+        chunk_bytes = 0
+        for row, size in itertools.izip(rows, sizes):
+            if chunk and chunk_bytes + size > max_statement_bytes:
+                self.executemany(cursor, sql, chunk)
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(row)
+            chunk_bytes = chunk_bytes + size
+        if chunk:
+            self.executemany(cursor, sql, chunk)
+
+    def insert_table(self, cursor, table, columns, rows, sizes):
+        """Insert rows of values for columns into table; see insert_rows()."""
+        self.insert_rows(cursor, "INSERT INTO %s (%s) VALUES (%s)"
+                         % (table, ", ".join(columns),
+                            ", ".join(["%s"] * len(columns))),
+                         rows, sizes)
+
+    def insert_spooled(self, cursor, attach_id, payload):
+        """Insert the attach_data row of an attachment that was spooled."""
+        self.execute(cursor, "INSERT INTO attach_data (id, thedata) VALUES (%s, %s)",
+                     [ attach_id, self.blob(payload.read()) ])
+
+    def delete_bugs(self, cursor, numbers, obsolete):
+        """Remove earlier imports of bugs that are about to be imported again.
+
+        Paths of their locally stored attachments are added to obsolete, to
+        be removed once the transaction has been committed.
+        """
+        marks = ", ".join(["%s"] * len(numbers))
+        if attachdir is not None:
+            self.execute(cursor, "SELECT attach_id FROM attachments" \
+                         " WHERE bug_id IN (%s)" % marks, numbers)
+            for (attach_id,) in cursor.fetchall():
+                obsolete.append(local_attachment_path(int(attach_id)))
+        self.execute(cursor, "DELETE FROM attach_data WHERE id IN" \
+                     " (SELECT attach_id FROM attachments WHERE bug_id IN (%s))"
+                     % marks, numbers)
+        for table in ("attachments", "longdescs", "bugs_fulltext", "bugs"):
+            self.execute(cursor, "DELETE FROM %s WHERE bug_id IN (%s)"
+                         % (table, marks), numbers)
+
+    def insert_bugs(self, cursor, bugs, stored, obsolete, stored_hashes,
+                    repointed):
+        """Insert processed bugs and everything attached to them.
+
+        Rows are grouped per table across all of the bugs, so a batch costs
+        a handful of statements no matter how many bugs, notes and
+        attachments it holds.  Attachment IDs are handed out from
+        next_attach_id so that their attach_data rows can go in the same way;
+        the next free ID is returned.  Attachments written to the local
+        attachment store are added to stored.  Bugs marked 'replace' have
+        their earlier rows deleted first.
+
+        With dedup_attachments, attachments already stored are left out;
+        the ones stored here are added to stored_hashes as (sha256,
+        attach_id, bug_id), and the number left out is returned too.  When
+        a replaced bug held the stored copy of an attachment, the comments
+        about copies elsewhere are pointed at where it is stored now (see
+        repoint_comments()), and the content_digest() of the bugs they are
+        on is put in repointed.
+        """
+        replaced = [ current['number'] for current in bugs if current['replace'] ]
+        moved = {}
+        if replaced:
+            self.delete_bugs(cursor, replaced, obsolete)
+            if self.attachment_index is not None:
+                numbers = set(replaced)
+                moved = dict([ (sha256, entry) for sha256, entry
+                               in self.attachment_index.entries.items()
+                               if entry[1] in numbers ])
+
+        if create_users:
+            self.create_users(cursor, bugs)
+
+        lookups = self.lookups
+        next_attach_id = self.next_attach_id
+        duplicates = 0
+        index = self.attachment_index
+        batch_hashes = {}
+        replaced = set(replaced)
+        local_size = max_attachment_size * 1024
+        bug_rows = []
+        comment_rows = []
+        fulltext_rows = []
+        attachment_rows = []
+        data_rows = []
+        spooled = []
+        for current in bugs:
+            reported = _ts(current['date-reported'])
+            who = lookups.user_id(current['who'])
+            bug_rows.append(
+                [ current['number'], current['bug_status'], reported, reported,
+                  current['short-description'],
+                  lookups.product_id(current['product']), reporter, who,
+                  current['version'],
+                  lookups.component_id(current['product'], current['component']),
+                  current['resolution'], current['bug_status'] != 'UNCONFIRMED',
+                  '---', current['bug_severity'], 'All', 'All' ])
+
+            # This is the initial long description associated with the bug report
+            description = body_text(current['description'])
+            comment_rows.append(
+                [ current['number'], who, reported, description ])
+
+            # Add whatever notes are associated with this defect
+            texts = [ description ]
+            for n in current['notes']:
+                comment_rows.append(
+                    [ current['number'], lookups.user_id(n.who),
+                      _ts(n.when), n.text ])
+                texts.append(n.text)
+
+            # add attachments associated with this defect
+            hashes = []
+            for a in current['attachments']:
+                if dedup_attachments:
+                    original = batch_hashes.get(a.payload.sha256)
+                    if original is None and index is not None:
+                        original = index.get(a.payload.sha256)
+                        if original is not None and original[1] in replaced:
+                            # Its rows were just deleted; store it again.
+                            original = None
+                    if original is not None:
+                        duplicates = duplicates + 1
+                        if original[1] != current['number']:
+                            text = "%s is identical to attachment %d on bug %d" \
+                                   % (a.filename, original[0], original[1])
+                        elif duplicate_comments:
+                            text = "%s is identical to attachment %d" \
+                                   % (a.filename, original[0])
+                        else:
+                            continue
+                        comment_rows.append(
+                            [ current['number'], lookups.user_id(a.who),
+                              reported, text ])
+                        texts.append(text)
+                        continue
+                    batch_hashes[a.payload.sha256] = (next_attach_id, current['number'])
+                hashes.append(a.payload.sha256)
+                attachment_rows.append(
+                    [ next_attach_id, current['number'], reported, reported,
+                      a.filename, a.mimetype, a.filename, lookups.user_id(a.who) ])
+                if attachdir is not None and a.payload.size > local_size:
+                    # Same rule as Bugzilla::Attachment->create: the file goes
+                    # to disk and attach_data gets an empty row.
+                    stored.append(store_local_attachment(next_attach_id, a.payload))
+                    data_rows.append([ next_attach_id, self.blob("") ])
+                elif a.payload.path is None:
+                    data_rows.append([ next_attach_id, self.blob(a.payload.read()) ])
+                else:
+                    spooled.append((next_attach_id, a.payload))
+                next_attach_id = next_attach_id + 1
+
+            # What Bugzilla::Bug::_sync_fulltext() would store, built from the
+            # comments in hand rather than read back from longdescs.  None of
+            # the comments are private.
+            comments = "\n".join(texts)
+            fulltext_rows.append(
+                [ current['number'], current['short-description'], comments,
+                  comments ])
+
+            if self.journal is not None:
+                # For --verify.
+                current['content-digest'] = content_digest(
+                    [ hashlib.sha256(t).hexdigest() for t in texts ], hashes)
+
+        self.insert_table(cursor, "bugs",
+                     ("bug_id", "bug_status", "creation_ts", "delta_ts",
+                      "short_desc", "product_id", "assigned_to", "reporter",
+                      "version", "component_id", "resolution", "everconfirmed",
+                      "priority", "bug_severity", "op_sys", "rep_platform"),
+                     bug_rows, [ len(r[4]) + 256 for r in bug_rows ])
+        self.insert_table(cursor, "longdescs",
+                     ("bug_id", "who", "bug_when", "thetext"),
+                     comment_rows, [ len(r[3]) + 64 for r in comment_rows ])
+        self.insert_table(cursor, "bugs_fulltext",
+                     ("bug_id", "short_desc", "comments", "comments_noprivate"),
+                     fulltext_rows,
+                     [ len(r[1]) + 2 * len(r[2]) + 64 for r in fulltext_rows ])
+        self.insert_table(cursor, "attachments",
+                     ("attach_id", "bug_id", "creation_ts", "modification_time",
+                      "description", "mimetype", "filename", "submitter_id"),
+                     attachment_rows,
+                     [ 2 * len(r[4]) + len(r[5]) + 128 for r in attachment_rows ])
+        self.insert_table(cursor, "attach_data", ("id", "thedata"),
+                     data_rows, [ 2 * len(r[1]) + 32 for r in data_rows ])
+        for attach_id, payload in spooled:
+            self.insert_spooled(cursor, attach_id, payload)
+        changed = set()
+        for sha256, entry in moved.items():
+            changed.update(self.repoint_comments(cursor, entry,
+                                                 batch_hashes.get(sha256)))
+        if changed and self.journal is not None:
+            db = self._connection()
+            for number in changed:
+                repointed.update(self.content_digests(db, number, number))
+        stored_hashes.extend([ (sha256, entry[0], entry[1])
+                               for sha256, entry in batch_hashes.items() ])
+        return next_attach_id, duplicates
+
+    def repoint_comments(self, cursor, old, new):
+        """Point the comments about copies of the attachment stored as old,
+        an (attach_id, bug_id) pair, at new instead; new is None if it
+        isn't stored anywhere now.  Returns the bugs whose comments
+        changed, after bringing their bugs_fulltext rows up to date.
+
+        Finding them takes a scan of longdescs, but only bugs imported
+        again with --journal, and holding the stored copy, get here.
+        """
+        suffix = " is identical to attachment %d on bug %d" % old
+        self.execute(cursor, "SELECT comment_id, bug_id, thetext FROM longdescs" \
+                     " WHERE thetext LIKE %s", [ "%" + suffix ])
+        changed = set()
+        for comment_id, bug_id, text in cursor.fetchall():
+            if not text.endswith(suffix):
+                continue
+            bug_id = int(bug_id)
+            filename = text[:-len(suffix)]
+            if new is None:
+                text = "%s was identical to attachment %d on bug %d, which" \
+                       " is no longer there" % ((filename,) + old)
+            elif new[1] == bug_id:
+                text = "%s is identical to attachment %d" % (filename, new[0])
+            else:
+                text = "%s is identical to attachment %d on bug %d" \
+                       % ((filename,) + new)
+            self.execute(cursor, "UPDATE longdescs SET thetext = %s" \
+                         " WHERE comment_id = %s", [ text, comment_id ])
+            changed.add(bug_id)
+        for bug_id in changed:
+            self.execute(cursor, "SELECT thetext FROM longdescs WHERE bug_id = %s" \
+                         " ORDER BY comment_id", [ bug_id ])
+            comments = "\n".join([ row[0] for row in cursor.fetchall() ])
+            self.execute(cursor, "UPDATE bugs_fulltext SET comments = %s," \
+                         " comments_noprivate = %s WHERE bug_id = %s",
+                         [ comments, comments, bug_id ])
+        return changed
+
+    def check_attachment_index(self):
+        """Forget the attachment index's entries that the database doesn't
+        bear out: the attachment is gone, or its ID is some other bug's.
+
+        The index is only right about the database it was written along
+        with; one restored from a dump, say, may differ.
+        """
+        index = self.attachment_index
+        entries = index.entries.items()
+        found = set()
+        db = self._connection()
+        cursor = db.cursor()
+        try:
+            for i in xrange(0, len(entries), 1000):
+                ids = [ entry[0] for sha256, entry in entries[i:i + 1000] ]
+                self.execute(cursor, "SELECT attach_id, bug_id FROM attachments" \
+                             " WHERE attach_id IN (%s)"
+                             % ", ".join(["%s"] * len(ids)), ids)
+                found.update([ (int(row[0]), int(row[1]))
+                               for row in cursor.fetchall() ])
+        finally:
+            cursor.close()
+        db.commit()
+        stale = [ sha256 for sha256, entry in entries if entry not in found ]
+        for sha256 in stale:
+            index.forget(sha256)
+        index.sync()
+        if stale:
+            sys.stderr.write("Dropped %d attachment index entries that don't"
+                             " match the database\n" % len(stale))
+
+    def first_attach_id(self, cursor):
+        """The first attach_id that isn't in use."""
+        self.execute(cursor, "SELECT COALESCE(MAX(attach_id), 0) + 1" \
+                     " FROM attachments")
+        return int(cursor.fetchone()[0])
+
+    def reserve_attach_ids(self, cursor, needed):
+        """The start and end of at least needed attachment IDs that nothing
+        else will take.
+
+        Here, just the next unused ones, asked for again by every batch:
+        writers to the database take turns, and a batch that loses a race
+        for them is retried like any failed batch.
+        """
+        start = self.first_attach_id(cursor)
+        return start, start + needed
+
+    def add_users(self, bugs):
+        """create_users() for bugs, in a transaction of its own."""
+        db = self._connection()
+        cursor = db.cursor()
+        self.new_users = []
+        try:
+            try:
+                self.create_users(cursor, bugs)
+            finally:
+                cursor.close()
+            db.commit()
+        except:
+            for login in self.new_users:
+                del self.lookups.users[login]
+            self._rollback()
+            raise
+        self.new_users = []
+
+    def reconcile_counters(self):
+        """Point the AUTO_INCREMENT counters of bugs and attachments past
+        the IDs the import gave out itself."""
+        pass
+
+    def _write(self, bugs):
+        db = self._connection()
+        cursor = db.cursor()
+        stored = []
+        obsolete = []
+        stored_hashes = []
+        repointed = {}
+        self.new_users = []
+        try:
+            try:
+                if self.attach_ids is not None:
+                    needed = sum([ len(current['attachments']) for current in bugs ])
+                    if (self.next_attach_id is None or
+                        self.next_attach_id + needed > self.attach_ids_end):
+                        self.next_attach_id, self.attach_ids_end = \
+                            self.attach_ids.take(needed)
+                elif self.throttle is not None:
+                    needed = sum([ len(current['attachments']) for current in bugs ])
+                    if (self.next_attach_id is None or
+                        self.next_attach_id + needed > self.attach_ids_end):
+                        self.next_attach_id, self.attach_ids_end = \
+                            self.reserve_attach_ids(cursor, needed)
+                elif self.next_attach_id is None:
+                    self.next_attach_id = self.first_attach_id(cursor)
+                next_attach_id, duplicates = self.insert_bugs(
+                    cursor, bugs, stored, obsolete, stored_hashes, repointed)
+            finally:
+                cursor.close()
+            db.commit()
+        except:
+            # Accounts and files for rows that were never committed must not
+            # linger.
+            for login in self.new_users:
+                del self.lookups.users[login]
+            self.new_users = []
+            for path in stored:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            raise
+        self.next_attach_id = next_attach_id
+        self.duplicates = self.duplicates + duplicates
+        release_bugs(bugs)
+        if self.attachment_index is not None:
+            index = self.attachment_index
+            index.discard_bugs([ current['number'] for current in bugs
+                                 if current['replace'] ])
+            for sha256, attach_id, bug_id in stored_hashes:
+                index.record(sha256, attach_id, bug_id)
+            index.sync()
+        for path in obsolete:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        if self.journal is not None:
+            self.journal.record_bugs(bugs)
+            for number, content in repointed.items():
+                entry = self.journal.get(number)
+                if entry is not None:
+                    self.journal.record(number, entry[0], entry[1], content)
+            self.journal.sync()
+
+    def add(self, current):
+        names = (current['product'], current['component'], current['version'])
+        if names not in self.checked:
+            self.check_names([ names ])
+        if not self.pending:
+            self.started = time.time()
+        self.pending.append(current)
+        batch = self.commit_every
+        if self.throttle is not None:
+            batch = self.throttle.batch
+        if (len(self.pending) >= batch or
+            time.time() - self.started >= self.commit_interval):
+            self.commit()
+
+    def commit(self):
+        if not self.pending:
+            return
+        started = time.time()
+        try:
+            self._write(self.pending)
+        except self.Error, message:
+            self._recover(message)
+        else:
+            self.pending = []
+        if self.throttle is not None:
+            self.throttle.committed(time.time() - started)
+
+    def _rollback(self):
+        # IDs handed out to the failed batch are free again; re-read them.
+        self.next_attach_id = None
+        if self.db is None:
+            return
+        try:
+            self.db.rollback()
+        except self.Error:
+            self._drop_connection()
+
+    def _recover(self, message):
+        """Roll back the current batch and replay it one bug at a time."""
+        batch = self.pending
+        self.pending = []
+        sys.stderr.write("Batch of %d bugs failed (%s); retrying one by one\n"
+                         % (len(batch), message))
+        self._rollback()
+        if self.is_disconnect(message):
+            self._drop_connection()
+
+        for current in batch:
+            try:
+                self._write([current])
+            except self.Error, message:
+                self._rollback()
+                # Only a bug that something else has put in the database
+                # since the import started counts as imported; a duplicate
+                # anywhere else is a failure like any other.
+                if (self.is_duplicate(message) and not current['replace']
+                    and self.bug_exists(current['number'])):
+                    sys.stderr.write("Bug %d is in the database already;"
+                                     " skipped\n" % current['number'])
+                else:
+                    sys.stderr.write("Bug %d not imported: %s\n"
+                                     % (current['number'], message))
+                    self.failed.append(current['number'])
+            release_bugs([current])
+
+    def close(self):
+        self.commit()
+        if bulk_load:
+            self.finish_bulk_load()
+        if defer_fulltext:
+            self.restore_fulltext()
+        self.release()
+
+    def release(self):
+        """Close the connection."""
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+def _tsv(value):
+    """value as a field of a file for LOAD DATA's default format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, (bool, int, long)):
+        return str(int(value))
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return value.replace("\\", "\\\\").replace("\t", "\\t") \
+                .replace("\n", "\\n").replace("\0", "\\0")
+
+def _by_table(objects, kind):
+    """schema_objects() of kind, grouped by table, in order."""
+    tables = collections.OrderedDict()
+    for o in objects:
+        if o[1] == kind:
+            tables.setdefault(o[0], []).append(o)
+    return tables.items()
+
+class MySQLWriter(BugWriter):
+    """Writes to a MySQL or MariaDB Bugzilla database through MySQLdb."""
+
+    def __init__(self, *args, **kwargs):
+        self.Error = MySQLdb.Error
+        self.load_data = False
+        self.charset = None
+        BugWriter.__init__(self, *args, **kwargs)
+
+    def connect(self):
+        params = dict(db_params)
+        for key in params.keys():
+            if params[key] is None:
+                del params[key]
+        if bulk_load:
+            params['local_infile'] = 1
+        db = MySQLdb.connect(**params)
+        db.autocommit(False)
+        if bulk_load:
+            cursor = db.cursor()
+            cursor.execute("SET SESSION foreign_key_checks = 0, unique_checks = 0")
+            cursor.close()
+        return db
+
+    def reconcile_counters(self):
+        db = self._connection()
+        cursor = db.cursor()
+        try:
+            for table, column in (("bugs", "bug_id"), ("attachments", "attach_id")):
+                self.execute(cursor, "SELECT COALESCE(MAX(%s), 0) + 1 FROM %s"
+                             % (column, table))
+                # InnoDB never sets the counter below MAX + 1, so this only
+                # ever moves it to just past the last row.
+                self.execute(cursor, "ALTER TABLE %s AUTO_INCREMENT = %d"
+                             % (table, int(cursor.fetchone()[0])))
+        finally:
+            cursor.close()
+        db.commit()
+
+    def reserve_attach_ids(self, cursor, needed):
+        # ALTER TABLE waits for transactions that added attachments to
+        # commit, and afterwards AUTO_INCREMENT hands out IDs past the
+        # block; if one of them took an ID in it first, try further on.
+        size = max(needed, AttachIdBlocks.block_size)
+        while True:
+            start = self.first_attach_id(cursor)
+            self.execute(cursor, "ALTER TABLE attachments AUTO_INCREMENT = %d"
+                         % (start + size))
+            self.execute(cursor, "SELECT COUNT(*) FROM attachments" \
+                         " WHERE attach_id >= %s", [ start ])
+            if not int(cursor.fetchone()[0]):
+                return start, start + size
+
+    def is_duplicate(self, error):
+        return isinstance(error, MySQLdb.IntegrityError) and error[0] == 1062
+
+    def is_disconnect(self, error):
+        return isinstance(error, MySQLdb.OperationalError)
+
+    def index_names(self, cursor, table):
+        self.execute(cursor, "SHOW INDEX FROM %s" % table)
+        return set([ row[2] for row in cursor.fetchall() ])
+
+    def schema_objects(self, cursor, tables):
+        objects = []
+        self.execute(cursor, "SELECT k.TABLE_NAME, k.CONSTRAINT_NAME, k.COLUMN_NAME," \
+                     " k.REFERENCED_TABLE_NAME, k.REFERENCED_COLUMN_NAME," \
+                     " r.UPDATE_RULE, r.DELETE_RULE" \
+                     " FROM information_schema.KEY_COLUMN_USAGE k" \
+                     " JOIN information_schema.REFERENTIAL_CONSTRAINTS r" \
+                     " ON r.CONSTRAINT_SCHEMA = k.CONSTRAINT_SCHEMA" \
+                     " AND r.TABLE_NAME = k.TABLE_NAME" \
+                     " AND r.CONSTRAINT_NAME = k.CONSTRAINT_NAME" \
+                     " WHERE k.TABLE_SCHEMA = DATABASE() AND k.TABLE_NAME IN (%s)" \
+                     " ORDER BY k.TABLE_NAME, k.CONSTRAINT_NAME, k.ORDINAL_POSITION"
+                     % ", ".join(["%s"] * len(tables)), list(tables))
+        keys = collections.OrderedDict()
+        for (table, name, column, ref_table, ref_column,
+             on_update, on_delete) in cursor.fetchall():
+            key = keys.setdefault((table, name),
+                                  [ [], ref_table, [], on_update, on_delete ])
+            key[0].append(column)
+            key[2].append(ref_column)
+        for (table, name), (columns, ref_table, ref_columns,
+                            on_update, on_delete) in keys.items():
+            objects.append([ table, 'foreign key', name,
+                             "CONSTRAINT %s FOREIGN KEY (%s) REFERENCES %s (%s)" \
+                             " ON UPDATE %s ON DELETE %s"
+                             % (name, ", ".join(columns), ref_table,
+                                ", ".join(ref_columns), on_update, on_delete) ])
+
+        for table in tables:
+            self.execute(cursor, "SHOW INDEX FROM %s" % table)
+            indexes = collections.OrderedDict()
+            for row in cursor.fetchall():
+                non_unique, name, column, sub_part, index_type = \
+                    row[1], row[2], row[4], row[7], row[10]
+                if name == 'PRIMARY':
+                    continue
+                if sub_part is not None:
+                    column = "%s(%d)" % (column, int(sub_part))
+                if index_type == 'FULLTEXT':
+                    kind = "FULLTEXT "
+                elif not int(non_unique):
+                    kind = "UNIQUE "
+                else:
+                    kind = ""
+                indexes.setdefault(name, [ kind, [] ])[1].append(column)
+            for name, (kind, columns) in indexes.items():
+                objects.append([ table, 'index', name, "%sINDEX %s (%s)"
+                                 % (kind, name, ", ".join(columns)) ])
+        return objects
+
+    def drop_objects(self, cursor, objects):
+        # Foreign keys go first; MySQL won't drop an index that one needs.
+        for kind, clause in (('foreign key', "DROP FOREIGN KEY %s"),
+                             ('index', "DROP INDEX %s")):
+            for table, group in _by_table(objects, kind):
+                self.execute(cursor, "ALTER TABLE %s %s" % (table,
+                             ", ".join([ clause % o[2] for o in group ])))
+
+    def create_objects(self, cursor, objects):
+        # With the checks back on, adding a foreign key checks every row.
+        self.execute(cursor, "SET SESSION foreign_key_checks = 1, unique_checks = 1")
+        for kind in ('index', 'foreign key'):
+            for table, group in _by_table(objects, kind):
+                # One ALTER TABLE builds all of a table's indexes in one
+                # pass, except that InnoDB adds FULLTEXT ones one at a time.
+                fulltext = [ o for o in group if o[3].startswith("FULLTEXT ") ]
+                parts = [ [ o for o in group if o not in fulltext ] ]
+                parts.extend([ [ o ] for o in fulltext ])
+                for part in parts:
+                    if part:
+                        self.execute(cursor, "ALTER TABLE %s %s" % (table,
+                                     ", ".join([ "ADD " + o[3] for o in part ])))
+
+    def start_bulk_load(self):
+        cursor = self._connection().cursor()
+        try:
+            self.execute(cursor, "SELECT @@GLOBAL.local_infile")
+            self.load_data = bool(int(cursor.fetchone()[0]))
+        finally:
+            cursor.close()
+        if not self.load_data:
+            sys.stderr.write("local_infile is off on the server; loading with INSERTs\n")
+        self.charset = self._connection().character_set_name()
+        BugWriter.start_bulk_load(self)
+
+    def _tsv_file(self, table):
+        fd, path = tempfile.mkstemp(prefix=table + ".", suffix=".tsv", dir=spool_dir)
+        return os.fdopen(fd, "wb"), path
+
+    def load_file(self, cursor, path, table, columns, count):
+        """LOAD DATA a file written with _tsv() into table."""
+        self.execute(cursor, "LOAD DATA LOCAL INFILE %%s INTO TABLE %s" \
+                     " CHARACTER SET %s (%s)"
+                     % (table, self.charset, ", ".join(columns)), [ path ])
+        # With LOCAL, rows the server won't take are skipped with a warning
+        # instead of failing the statement.
+        if cursor.rowcount != count:
+            raise MySQLdb.DataError("LOAD DATA loaded %d of %d rows into %s"
+                                    % (cursor.rowcount, count, table))
+
+    def insert_table(self, cursor, table, columns, rows, sizes):
+        if not self.load_data:
+            BugWriter.insert_table(self, cursor, table, columns, rows, sizes)
+            return
+        if not rows:
+            return
+        f, path = self._tsv_file(table)
+        try:
+            try:
+                for row in rows:
+                    f.write("\t".join(map(_tsv, row)) + "\n")
+            finally:
+                f.close()
+            self.load_file(cursor, path, table, columns, len(rows))
+        finally:
+            os.unlink(path)
+
+    def insert_spooled(self, cursor, attach_id, payload):
+        if self.load_data:
+            f, path = self._tsv_file("attach_data")
+            try:
+                try:
+                    f.write("%d\t" % attach_id)
+                    for chunk in payload.chunks():
+                        f.write(_tsv(chunk))
+                    f.write("\n")
+                finally:
+                    f.close()
+                self.load_file(cursor, path, "attach_data", ("id", "thedata"), 1)
+            finally:
+                os.unlink(path)
+            return
+        # One INSERT, as Bugzilla itself sends attachments; the row has to
+        # fit in max_allowed_packet either way.  Appending chunks would copy
+        # the whole BLOB again for every one, and CONCAT() gives NULL past
+        # max_allowed_packet anyway.
+        BugWriter.insert_spooled(self, cursor, attach_id, payload)
+
+# The part of Bugzilla/DB/Schema.pm the importer writes to, as
+# Bugzilla/DB/Schema/Sqlite.pm would create it.
+sqlite_schema = """
+CREATE TABLE IF NOT EXISTS profiles (
+    userid integer PRIMARY KEY AUTOINCREMENT,
+    login_name varchar(255) NOT NULL,
+    cryptpassword varchar(128),
+    realname varchar(255) NOT NULL DEFAULT '',
+    disabledtext text NOT NULL DEFAULT '',
+    disable_mail integer NOT NULL DEFAULT 0,
+    mybugslink integer NOT NULL DEFAULT 1,
+    extern_id varchar(64),
+    is_enabled integer NOT NULL DEFAULT 1,
+    last_seen_date DATETIME
+);
+CREATE UNIQUE INDEX IF NOT EXISTS profiles_login_name_idx
+    ON profiles (login_name COLLATE NOCASE);
+CREATE UNIQUE INDEX IF NOT EXISTS profiles_extern_id_idx ON profiles (extern_id);
+
+CREATE TABLE IF NOT EXISTS products (
+    id integer PRIMARY KEY AUTOINCREMENT,
+    name varchar(64) NOT NULL,
+    classification_id integer NOT NULL DEFAULT 1,
+    description text NOT NULL,
+    isactive integer NOT NULL DEFAULT 1,
+    defaultmilestone varchar(64) NOT NULL DEFAULT '---',
+    allows_unconfirmed integer NOT NULL DEFAULT 1
+);
+CREATE UNIQUE INDEX IF NOT EXISTS products_name_idx ON products (name COLLATE NOCASE);
+
+CREATE TABLE IF NOT EXISTS components (
+    id integer PRIMARY KEY AUTOINCREMENT,
+    name varchar(64) NOT NULL,
+    product_id integer NOT NULL REFERENCES products (id) ON DELETE CASCADE,
+    initialowner integer NOT NULL,
+    initialqacontact integer,
+    description text NOT NULL,
+    isactive integer NOT NULL DEFAULT 1
+);
+CREATE UNIQUE INDEX IF NOT EXISTS components_product_id_idx
+    ON components (product_id, name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS components_name_idx ON components (name);
+
+CREATE TABLE IF NOT EXISTS versions (
+    id integer PRIMARY KEY AUTOINCREMENT,
+    value varchar(64) NOT NULL,
+    product_id integer NOT NULL REFERENCES products (id) ON DELETE CASCADE,
+    isactive integer NOT NULL DEFAULT 1
+);
+CREATE UNIQUE INDEX IF NOT EXISTS versions_product_id_idx
+    ON versions (product_id, value COLLATE NOCASE);
+
+CREATE TABLE IF NOT EXISTS bugs (
+    bug_id integer PRIMARY KEY AUTOINCREMENT,
+    assigned_to integer NOT NULL,
+    bug_file_loc text NOT NULL DEFAULT '',
+    bug_severity varchar(64) NOT NULL,
+    bug_status varchar(64) NOT NULL,
+    creation_ts DATETIME,
+    delta_ts DATETIME NOT NULL,
+    short_desc varchar(255) NOT NULL,
+    op_sys varchar(64) NOT NULL,
+    priority varchar(64) NOT NULL,
+    product_id integer NOT NULL,
+    rep_platform varchar(64) NOT NULL,
+    reporter integer NOT NULL,
+    version varchar(64) NOT NULL,
+    component_id integer NOT NULL,
+    resolution varchar(64) NOT NULL DEFAULT '',
+    target_milestone varchar(64) NOT NULL DEFAULT '---',
+    qa_contact integer,
+    status_whiteboard text NOT NULL DEFAULT '',
+    lastdiffed DATETIME,
+    everconfirmed integer NOT NULL,
+    reporter_accessible integer NOT NULL DEFAULT 1,
+    cclist_accessible integer NOT NULL DEFAULT 1,
+    estimated_time decimal(7,2) NOT NULL DEFAULT 0,
+    remaining_time decimal(7,2) NOT NULL DEFAULT 0,
+    deadline DATETIME
+);
+CREATE INDEX IF NOT EXISTS bugs_assigned_to_idx ON bugs (assigned_to);
+CREATE INDEX IF NOT EXISTS bugs_creation_ts_idx ON bugs (creation_ts);
+CREATE INDEX IF NOT EXISTS bugs_delta_ts_idx ON bugs (delta_ts);
+CREATE INDEX IF NOT EXISTS bugs_bug_severity_idx ON bugs (bug_severity);
+CREATE INDEX IF NOT EXISTS bugs_bug_status_idx ON bugs (bug_status);
+CREATE INDEX IF NOT EXISTS bugs_op_sys_idx ON bugs (op_sys);
+CREATE INDEX IF NOT EXISTS bugs_priority_idx ON bugs (priority);
+CREATE INDEX IF NOT EXISTS bugs_product_id_idx ON bugs (product_id);
+CREATE INDEX IF NOT EXISTS bugs_reporter_idx ON bugs (reporter);
+CREATE INDEX IF NOT EXISTS bugs_version_idx ON bugs (version);
+CREATE INDEX IF NOT EXISTS bugs_component_id_idx ON bugs (component_id);
+CREATE INDEX IF NOT EXISTS bugs_resolution_idx ON bugs (resolution);
+CREATE INDEX IF NOT EXISTS bugs_target_milestone_idx ON bugs (target_milestone);
+CREATE INDEX IF NOT EXISTS bugs_qa_contact_idx ON bugs (qa_contact);
+
+CREATE TABLE IF NOT EXISTS longdescs (
+    comment_id integer PRIMARY KEY AUTOINCREMENT,
+    bug_id integer NOT NULL REFERENCES bugs (bug_id) ON DELETE CASCADE,
+    who integer NOT NULL,
+    bug_when DATETIME NOT NULL,
+    work_time decimal(7,2) NOT NULL DEFAULT 0,
+    thetext text NOT NULL,
+    isprivate integer NOT NULL DEFAULT 0,
+    already_wrapped integer NOT NULL DEFAULT 0,
+    type integer NOT NULL DEFAULT 0,
+    extra_data varchar(255)
+);
+CREATE INDEX IF NOT EXISTS longdescs_bug_id_idx ON longdescs (bug_id, work_time);
+CREATE INDEX IF NOT EXISTS longdescs_who_idx ON longdescs (who, bug_id);
+CREATE INDEX IF NOT EXISTS longdescs_bug_when_idx ON longdescs (bug_when);
+
+CREATE TABLE IF NOT EXISTS bugs_fulltext (
+    bug_id integer PRIMARY KEY REFERENCES bugs (bug_id) ON DELETE CASCADE,
+    short_desc varchar(255) NOT NULL,
+    comments text,
+    comments_noprivate text
+);
+CREATE INDEX IF NOT EXISTS bugs_fulltext_short_desc_idx ON bugs_fulltext (short_desc);
+CREATE INDEX IF NOT EXISTS bugs_fulltext_comments_idx ON bugs_fulltext (comments);
+CREATE INDEX IF NOT EXISTS bugs_fulltext_comments_noprivate_idx
+    ON bugs_fulltext (comments_noprivate);
+
+CREATE TABLE IF NOT EXISTS attachments (
+    attach_id integer PRIMARY KEY AUTOINCREMENT,
+    bug_id integer NOT NULL REFERENCES bugs (bug_id) ON DELETE CASCADE,
+    creation_ts DATETIME NOT NULL,
+    modification_time DATETIME NOT NULL,
+    description text NOT NULL,
+    mimetype text NOT NULL,
+    ispatch integer NOT NULL DEFAULT 0,
+    filename varchar(255) NOT NULL,
+    submitter_id integer NOT NULL,
+    isobsolete integer NOT NULL DEFAULT 0,
+    isprivate integer NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS attachments_bug_id_idx ON attachments (bug_id);
+CREATE INDEX IF NOT EXISTS attachments_creation_ts_idx ON attachments (creation_ts);
+CREATE INDEX IF NOT EXISTS attachments_modification_time_idx
+    ON attachments (modification_time);
+CREATE INDEX IF NOT EXISTS attachments_submitter_id_idx
+    ON attachments (submitter_id, bug_id);
+
+CREATE TABLE IF NOT EXISTS attach_data (
+    id integer PRIMARY KEY REFERENCES attachments (attach_id) ON DELETE CASCADE,
+    thedata blob NOT NULL
+);
+"""
+
+def _sha2(value, bits):
+    """MySQL's SHA2(), for SQLite; only SHA-256 of BLOBs is needed."""
+    if value is None or bits != 256:
+        return None
+    return hashlib.sha256(str(value)).hexdigest()
+
+class SQLiteWriter(BugWriter):
+    """Writes to a SQLite database, creating the tables it needs.
+
+    This can be a Bugzilla installation using SQLite, or just a local file
+    to measure and regression-test the importer with.  SQLite has no way to
+    append to a BLOB, so spooled attachments are read whole when inserted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.Error = sqlite3.Error
+        BugWriter.__init__(self, *args, **kwargs)
+        db = self._connection()
+        db.executescript(sqlite_schema)
+        db.commit()
+
+    def connect(self):
+        # The connection is opened here but used by the writer thread.
+        db = sqlite3.connect(db_params['db'], check_same_thread=False)
+        db.text_factory = str
+        db.create_function("SHA2", 2, _sha2)
+        db.execute("PRAGMA foreign_keys = %s" % (bulk_load and "OFF" or "ON"))
+        return db
+
+    def load_lookups(self, names):
+        # A database without any products is a scratch file rather than a
+        # Bugzilla installation; give it the products the bugs are filed
+        # under.
+        db = self._connection()
+        self.scratch = db.execute("SELECT COUNT(*) FROM products").fetchone()[0] == 0
+        BugWriter.load_lookups(self, names)
+
+    def check_names(self, names):
+        new = [ triple for triple in names if triple not in self.checked ]
+        if self.scratch and new:
+            db = self._connection()
+            for product_name, component_name, value in new:
+                db.execute("INSERT OR IGNORE INTO products (name, description)" \
+                           " VALUES (?, '')", [ product_name ])
+                db.execute("INSERT OR IGNORE INTO components (name, product_id," \
+                           " initialowner, description)" \
+                           " SELECT ?, id, ?, '' FROM products WHERE name = ?",
+                           [ component_name, reporter, product_name ])
+                db.execute("INSERT OR IGNORE INTO versions (value, product_id)" \
+                           " SELECT ?, id FROM products WHERE name = ?",
+                           [ value, product_name ])
+            db.commit()
+            self.read_lookups()
+        BugWriter.check_names(self, names)
+
+    def reconcile_counters(self):
+        db = self._connection()
+        for table, column in (("bugs", "bug_id"), ("attachments", "attach_id")):
+            db.execute("UPDATE sqlite_sequence SET seq =" \
+                       " (SELECT COALESCE(MAX(%s), 0) FROM %s) WHERE name = ?"
+                       % (column, table), [ table ])
+        db.commit()
+
+    def insert_bugs(self, cursor, bugs, *args):
+        result = BugWriter.insert_bugs(self, cursor, bugs, *args)
+        if inject_latency is not None:
+            # Hold the transaction open, as a busy server would.
+            time.sleep(inject_latency[0] + inject_latency[1] * len(bugs))
+        return result
+
+    def is_duplicate(self, error):
+        return (isinstance(error, sqlite3.IntegrityError)
+                and "unique" in str(error).lower())
+
+    def blob(self, data):
+        return sqlite3.Binary(data)
+
+    def index_names(self, cursor, table):
+        self.execute(cursor, "PRAGMA index_list(%s)" % table)
+        return set([ row[1] for row in cursor.fetchall() ])
+
+    # Foreign keys are part of SQLite's table definitions, so only indexes
+    # are dropped for a bulk load.
+    def schema_objects(self, cursor, tables):
+        self.execute(cursor, "SELECT tbl_name, name, sql FROM sqlite_master" \
+                     " WHERE type = 'index' AND sql IS NOT NULL" \
+                     " AND tbl_name IN (%s) ORDER BY tbl_name, name"
+                     % ", ".join(["%s"] * len(tables)), list(tables))
+        return [ [ table, 'index', name, sql ]
+                 for table, name, sql in cursor.fetchall() ]
+
+    def drop_objects(self, cursor, objects):
+        for o in objects:
+            self.execute(cursor, "DROP INDEX %s" % o[2])
+
+    def create_objects(self, cursor, objects):
+        for o in objects:
+            self.execute(cursor, o[3])
+
+    def check_constraints(self, cursor, tables):
+        for table in tables:
+            self.execute(cursor, "PRAGMA foreign_key_check(%s)" % table)
+            rows = cursor.fetchall()
+            if rows:
+                raise RuntimeError("%d rows of %s break a foreign key into %s"
+                                   % (len(rows), table, rows[0][2]))
+
+    # SQLite has no FULLTEXT indexes; Bugzilla makes them plain ones there.
+    def drop_index_sql(self, table, name):
+        return "DROP INDEX %s" % name
+
+    def fulltext_index_sql(self, table, name, column):
+        return "CREATE INDEX %s ON %s (%s)" % (name, table, column)
+
+    # SQLite keeps the bytes it was given, but hands text that isn't UTF-8
+    # to Python functions as NULL.
+    def sent_bytes_sql(self, db, column):
+        return "CAST(%s AS BLOB)" % column
+
+    def execute(self, cursor, sql, args=()):
+        BugWriter.execute(self, cursor, sql.replace("%s", "?"), args)
+
+    def executemany(self, cursor, sql, rows):
+        BugWriter.executemany(self, cursor, sql.replace("%s", "?"), rows)
+
+db_drivers = {
+    'mysql': MySQLWriter,
+    'sqlite': SQLiteWriter,
+}
+
+class AttachIdBlocks:
+    """Hands out blocks of attachment IDs to ShardedWriter's writers."""
+
+    block_size = 1000
+
+    def __init__(self, first):
+        self.next = first
+        self.lock = threading.Lock()
+
+    def take(self, needed):
+        """The start and end of a block of at least needed unused IDs."""
+        with self.lock:
+            start = self.next
+            self.next = start + max(needed, self.block_size)
+            return start, self.next
+
+class ShardedWriter:
+    """Spreads bugs over several BugWriters writing side by side.
+
+    Bugs go to writers by bug_id range (see shard_range), so each writer
+    fills its own parts of the tables' keys.  Every writer has its own
+    connection, batches and transactions, and runs in its own thread;
+    attachment IDs come from a shared AttachIdBlocks.  One more BugWriter,
+    the coordinator, does what is done once per import: finding existing
+    bugs, checking names, preparing and restoring the schema, creating
+    users (each in a transaction of its own, so that all writers see them),
+    and setting the AUTO_INCREMENT counters at the end.
+
+    A writer that fails outright stops, and the rest of its bugs are
+    counted as failed; the other writers carry on.  It has the same
+    interface as BugWriter.
+    """
+
+    def __init__(self, factory, count, journal=None):
+        self.coordinator = factory(commit_every, commit_interval, journal)
+        self.shards = []
+        self.queues = []
+        self.lost = []
+        for i in range(count):
+            shard = factory(commit_every, commit_interval, journal)
+            # Names and users are looked up and checked once, by the
+            # coordinator.
+            shard.lookups = self.coordinator.lookups
+            shard.checked = self.coordinator.checked
+            self.shards.append(shard)
+            self.queues.append(Queue.Queue(write_queue_size))
+            self.lost.append([])
+        self.errors = [ None ] * count
+        self.threads = []
+        self.throttle = None
+
+    def _get_attachment_index(self):
+        return self.coordinator.attachment_index
+
+    def _set_attachment_index(self, index):
+        for writer in [ self.coordinator ] + self.shards:
+            writer.attachment_index = index
+
+    attachment_index = property(_get_attachment_index, _set_attachment_index)
+
+    def existing_bug_ids(self):
+        return self.coordinator.existing_bug_ids()
+
+    def load_lookups(self, names):
+        self.coordinator.load_lookups(names)
+
+    def prepare(self):
+        self.coordinator.prepare()
+        cursor = self.coordinator._connection().cursor()
+        try:
+            blocks = AttachIdBlocks(self.coordinator.first_attach_id(cursor))
+        finally:
+            cursor.close()
+        self.coordinator._connection().commit()
+        for i, shard in enumerate(self.shards):
+            if shard.throttle is None:
+                # Throttled writers reserve their own.
+                shard.attach_ids = blocks
+            # What the coordinator found out about bulk loading, for MySQL.
+            for name in ("load_data", "charset"):
+                if hasattr(self.coordinator, name):
+                    setattr(shard, name, getattr(self.coordinator, name))
+            thread = threading.Thread(target=self._run, args=(i,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self, i):
+        shard = self.shards[i]
+        queue = self.queues[i]
+        current = None
+        try:
+            while True:
+                current = queue.get()
+                if current is _end:
+                    shard.commit()
+                    return
+                shard.add(current)
+        except:
+            self.errors[i] = sys.exc_info()
+            sys.stderr.write("Writer %d failed: %s; its remaining bugs are not"
+                             " imported\n" % (i + 1, self.errors[i][1]))
+            # Keep taking bugs so that add() never blocks on this writer.
+            lost = [ c['number'] for c in shard.pending ]
+            release_bugs(shard.pending)
+            shard.pending = []
+            while current is not _end:
+                if current is not None:
+                    lost.append(current['number'])
+                    release_bugs([ current ])
+                current = queue.get()
+            self.lost[i] = lost
+
+    def add(self, current):
+        names = (current['product'], current['component'], current['version'])
+        if names not in self.coordinator.checked:
+            self.coordinator.check_names([ names ])
+        if create_users:
+            self.coordinator.add_users([ current ])
+        i = (current['number'] // shard_range) % len(self.shards)
+        self.queues[i].put(current)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        for queue in self.queues:
+            queue.put(_end)
+        for thread in self.threads:
+            thread.join()
+        for shard in self.shards:
+            shard.release()
+        coordinator = self.coordinator
+        if bulk_load:
+            coordinator.finish_bulk_load()
+        if defer_fulltext:
+            coordinator.restore_fulltext()
+        coordinator.reconcile_counters()
+        coordinator.release()
+
+    def _total(self, name):
+        return sum([ getattr(w, name) for w in [ self.coordinator ] + self.shards ])
+
+    statements = property(lambda self: self._total('statements'))
+    duplicates = property(lambda self: self._total('duplicates'))
+
+    def _failed(self):
+        failed = []
+        for shard, lost in zip(self.shards, self.lost):
+            failed.extend(shard.failed)
+            failed.extend(lost)
+        return sorted(failed)
+
+    failed = property(_failed)
+
+    def summary(self):
+        """Per-writer figures for the stats file."""
+        result = []
+        for shard, error, lost in zip(self.shards, self.errors, self.lost):
+            entry = {'statements': shard.statements,
+                     'failed': len(shard.failed) + len(lost)}
+            if error is not None:
+                entry['error'] = str(error[1])
+            if shard.throttle is not None:
+                entry['throttle'] = shard.throttle.summary()
+            result.append(entry)
+        return result
+
+def _export_time(t):
+    return time.strftime("%Y-%m-%d %H:%M:%S +0000", time.gmtime(t))
+
+def _login(who):
+    """The login name to export for a message_sender()."""
+    if who is None:
+        return exporter
+    return who[1]
+
+def _is_xml_text(text):
+    """Whether text is UTF-8 that can go into an XML document as it is."""
+    try:
+        text = text.decode("utf-8")
+    except UnicodeError:
+        return False
+    return not re.search(u"[^\t\n\r\u0020-\ud7ff\ue000-\ufffd]", text)
+
+class Exporter:
+    """Streams bugs to a file instead of the database, one bug at a time.
+
+    It has the same interface as BugWriter, so the rest of the importer
+    doesn't need to know where bugs go.  Subclasses write the format.
+    """
+
+    def __init__(self, path, compress=False):
+        if compress:
+            self.f = gzip.open(path, "wb")
+        else:
+            self.f = open(path, "wb")
+        self.next_attach_id = 1
+        self.failed = []
+        self.journal = None
+        self.statements = 0
+        self.duplicates = 0
+        self.throttle = None
+        self.start()
+
+    def existing_bug_ids(self):
+        return set()
+
+    def load_lookups(self, names):
+        # Names are resolved by whatever imports the export.
+        pass
+
+    def prepare(self):
+        pass
+
+    def add(self, current):
+        self.write_bug(current)
+        release_bugs([current])
+        if self.journal is not None:
+            self.journal.record(current['number'], current['signature'],
+                                current['digest'])
+
+    def commit(self):
+        self.f.flush()
+
+    def close(self):
+        self.finish()
+        self.f.close()
+
+    def start(self):
+        pass
+
+    def finish(self):
+        pass
+
+class XMLExporter(Exporter):
+    """Writes bugs as the XML that importxml.pl reads."""
+
+    def start(self):
+        self.f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n')
+        self.f.write('<bugzilla version=%s urlbase=%s maintainer=%s exporter=%s>\n'
+                     % (quoteattr(xml_version), quoteattr(urlbase), quoteattr(exporter), quoteattr(exporter)))
+
+    def finish(self):
+        self.f.write('</bugzilla>\n')
+
+    def _field(self, name, value):
+        self.f.write("    <%s>%s</%s>\n" % (name, escape(str(value)), name))
+
+    def _text(self, name, text):
+        if _is_xml_text(text):
+            self.f.write("      <%s>%s</%s>\n" % (name, escape(text), name))
+        else:
+            self.f.write('      <%s encoding="base64">%s</%s>\n'
+                         % (name, base64.b64encode(text), name))
+
+    def _comment(self, who, when, text):
+        self.f.write('    <long_desc isprivate="0">\n')
+        self.f.write("      <who>%s</who>\n" % escape(_login(who)))
+        self.f.write("      <bug_when>%s</bug_when>\n" % _export_time(when))
+        self._text("thetext", text)
+        self.f.write("    </long_desc>\n")
+
+    def write_bug(self, current):
+        reported = _export_time(current['date-reported'])
+        self.f.write("  <bug>\n")
+        self._field("bug_id", current['number'])
+        self._field("creation_ts", reported)
+        self._field("delta_ts", reported)
+        short_desc = current['short-description']
+        if not _is_xml_text(short_desc):
+            short_desc = re.sub(r"[\x00-\x08\x0b\x0c\x0e-\x1f]", "", short_desc)
+            short_desc = _json_text(short_desc).encode("utf-8")
+        self._field("short_desc", short_desc)
+        self._field("product", current['product'])
+        self._field("component", current['component'])
+        self._field("version", current['version'])
+        self._field("rep_platform", "All")
+        self._field("op_sys", "All")
+        self._field("bug_status", current['bug_status'])
+        self._field("resolution", current['resolution'])
+        self._field("priority", "---")
+        self._field("bug_severity", current['bug_severity'])
+        self._field("everconfirmed", int(current['bug_status'] != 'UNCONFIRMED'))
+        self._field("reporter", _login(current['who']))
+        self._field("assigned_to", exporter)
+        self._comment(current['who'], current['date-reported'],
+                      body_text(current['description']))
+        for n in current['notes']:
+            self._comment(n.who, n.when, n.text)
+        for a in current['attachments']:
+            self.f.write('    <attachment isobsolete="0" ispatch="0" isprivate="0">\n')
+            self.f.write("      <attachid>%d</attachid>\n" % self.next_attach_id)
+            self.f.write("      <date>%s</date>\n" % reported)
+            self.f.write("      <desc>%s</desc>\n" % escape(a.filename))
+            self.f.write("      <filename>%s</filename>\n" % escape(a.filename))
+            self.f.write("      <type>%s</type>\n" % escape(a.mimetype))
+            self.f.write("      <attacher>%s</attacher>\n" % escape(_login(a.who)))
+            self.f.write('      <data encoding="base64">')
+            # 57 bytes make one 76 character line of base64.
+            for chunk in a.payload.chunks(57 * 16384):
+                self.f.write(base64.encodestring(chunk))
+            self.f.write("</data>\n")
+            self.f.write("    </attachment>\n")
+            self.next_attach_id = self.next_attach_id + 1
+        self.f.write("  </bug>\n")
+
+def _json_text(text):
+    """Text as unicode for JSON; bytes that aren't UTF-8 are read as Latin-1."""
+    try:
+        return text.decode("utf-8")
+    except UnicodeError:
+        return text.decode("latin-1")
+
+class JSONExporter(Exporter):
+    """Writes one JSON object per line and bug.
+
+    Attachment data is base64 encoded and streamed into the line, so a big
+    attachment is never held in memory whole.
+    """
+
+    def write_bug(self, current):
+        bug = collections.OrderedDict()
+        bug['bug_id'] = current['number']
+        bug['creation_ts'] = _export_time(current['date-reported'])
+        bug['short_desc'] = _json_text(current['short-description'])
+        for key in ('product', 'component', 'version', 'bug_status',
+                    'resolution', 'bug_severity'):
+            bug[key] = current[key]
+        bug['reporter'] = _json_text(_login(current['who']))
+        bug['comments'] = [ { 'who': bug['reporter'],
+                              'bug_when': bug['creation_ts'],
+                              'thetext': _json_text(body_text(current['description'])) } ]
+        for n in current['notes']:
+            bug['comments'].append({ 'who': _json_text(_login(n.who)),
+                                     'bug_when': _export_time(n.when),
+                                     'thetext': _json_text(n.text) })
+        line = json.dumps(bug)
+        if not current['attachments']:
+            self.f.write(line + "\n")
+            return
+
+        self.f.write(line[:-1] + ', "attachments": [')
+        for i, a in enumerate(current['attachments']):
+            if i:
+                self.f.write(", ")
+            self.f.write(json.dumps(collections.OrderedDict([
+                ('filename', _json_text(a.filename)), ('mimetype', a.mimetype),
+                ('attacher', _json_text(_login(a.who))), ('size', a.payload.size)]))[:-1])
+            self.f.write(', "data": "')
+            for chunk in a.payload.chunks(3 * 349525):
+                self.f.write(base64.b64encode(chunk))
+            self.f.write('"}')
+        self.f.write("]}\n")
+
+class Stats:
+    """Counters, per-stage timings and progress reports for a run.
+
+    Stages are timed where they run, which may be a parser process, and
+    reach this through each bug's 'timings'.  Stages nest: 'bug' is all of
+    process_jitterbug(), and includes 'read' (file I/O), 'mime' (email
+    parsing), 'notes' (add_notes()) and 'attachments' (decoding).  'write'
+    is the time spent in the writer.
+    """
+
+    slowest_count = 10
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}
+        self.counters = dict.fromkeys(('bugs', 'notes', 'attachments', 'files',
+                                       'bytes_read', 'bytes_decoded'), 0)
+        self.slowest = []
+        self.total = None
+        self.total_bytes = 0
+        self.last_report = self.started
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def selected(self, bugs):
+        """Note the bugs about to be imported, for the progress reports."""
+        self.total = len(bugs)
+        for files in bugs:
+            for name, st in _bug_files(files):
+                self.total_bytes = self.total_bytes + st.st_size
+
+    def bug_done(self, current):
+        self.count('files', current['files'])
+        self.count('bytes_read', current['bytes'])
+        self.count('bugs')
+        if current.get('cached'):
+            self.count('parse_cache_hits')
+        self.count('notes', len(current['notes']))
+        self.count('attachments', len(current['attachments']))
+        for a in current['attachments']:
+            self.count('bytes_decoded', a.payload.size)
+        for name, t in current['timings'].items():
+            total = self.stages.setdefault(name, [0, 0.0, 0.0])
+            total[0] = total[0] + t[0]
+            total[1] = total[1] + t[1]
+            total[2] = total[2] + t[2]
+        seconds = current['timings']['bug'][1]
+        if len(self.slowest) < self.slowest_count:
+            heapq.heappush(self.slowest, (seconds, current['number']))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, current['number']))
+        self.progress()
+
+    def progress(self, done=False):
+        if progress_interval is None:
+            return
+        now = time.time()
+        if not done and now - self.last_report < progress_interval:
+            return
+        self.last_report = now
+        elapsed = max(now - self.started, 0.001)
+        bugs = self.counters['bugs']
+        rate = bugs / elapsed
+        if self.total is None:
+            line = "%d bugs" % bugs
+        else:
+            line = "%d/%d bugs" % (bugs, self.total)
+        line = line + ", %.1f bugs/s, %.2f MB/s" \
+               % (rate, self.counters['bytes_read'] / elapsed / 1048576.0)
+        if not done and rate > 0 and self.total is not None:
+            left = int((self.total - bugs) / rate)
+            line = line + ", ETA %d:%02d:%02d" % (left // 3600, left // 60 % 60, left % 60)
+        if sys.stderr.isatty():
+            sys.stderr.write("\r%-72s" % line)
+            if done:
+                sys.stderr.write("\n")
+        else:
+            sys.stderr.write(line + "\n")
+
+    def summary(self, writer):
+        result = dict(self.counters)
+        result['elapsed'] = time.time() - self.started
+        result['statements'] = writer.statements
+        result['failed'] = len(writer.failed)
+        result['duplicate_attachments'] = writer.duplicates
+        if writer.throttle is not None:
+            result['throttle'] = writer.throttle.summary()
+        if isinstance(writer, ShardedWriter):
+            result['writers'] = writer.summary()
+        if budget is not None:
+            result['memory_budget'] = {'limit': budget.limit, 'peak': budget.peak,
+                                       'spilled_bugs': budget.spilled}
+        result['stages'] = dict(
+            (name, {'calls': t[0], 'wall': round(t[1], 6), 'cpu': round(t[2], 6)})
+            for name, t in self.stages.items())
+        result['slowest_bugs'] = [ {'bug': number, 'seconds': round(seconds, 6)}
+                                   for seconds, number
+                                   in sorted(self.slowest, reverse=True) ]
+        return result
+
+def usage():
+    print """Usage: jb2bz.py [OPTIONS] [--archive=FILE | --mbox=PATH] Product
+       jb2bz.py [OPTIONS] --tree=ROOT
+
+Where OPTIONS are one or more of the following:
+
+  -h                This help information.
+  -s STATUS         One of UNCONFIRMED, CONFIRMED, IN_PROGRESS, RESOLVED, VERIFIED
+                    (default is CONFIRMED)
+  -c COMPONENT      The component to attach to each bug as it is important. This should be
+                    valid component for the Product.
+  -v VERSION        Version to assign to these defects.
+  --tree=ROOT       Import every <product>[-<version>]-<kind> directory in
+                    ROOT, where kind is bugs, requests, resolved or
+                    verified, in one run.  Product and version come from
+                    the name (-v is used if it has no version), and kind
+                    sets the status: CONFIRMED for bugs and requests
+                    (requests with severity enhancement), RESOLVED FIXED
+                    and VERIFIED FIXED.  A version must start with a digit.
+                    ROOT can also be a tar or zip archive holding these
+                    directories.
+  --mbox=PATH       Import the threads of an mbox file, or of a Maildir if
+                    PATH is a directory, as bugs: a thread's first message
+                    is the report and the others its replies.  Threads are
+                    found by Message-ID, In-Reply-To and References.
+  --first-bug=N     Number the threads' bugs from N on, in the order their
+                    first messages are stored (default 1).
+  --archive=FILE    Read the bugs from a tar or zip archive (.tar.gz,
+                    .tar.bz2, .tar.zst, ...) in one pass, without
+                    extracting it, instead of from the current directory.
+                    A directory's files must be stored together, as tar
+                    and zip store them.
+  --db-driver=DRIVER
+                    mysql (the default, also for MariaDB) or sqlite.
+  --db-host=HOST, --db-port=PORT, --db-name=NAME, --db-user=USER,
+  --db-password=PASSWORD
+                    Database connection settings (default: database bugs on
+                    localhost as root).  For sqlite, NAME is the database file.
+  --commit-every=N  Commit after every N bugs (default 100).
+  --commit-interval=SECONDS
+                    Commit a partial batch once it is this old (default 10).
+  --throttle=SECONDS For a Bugzilla in use: aim for transactions of at most
+                    this long, making batches smaller (down to one bug)
+                    and pausing between them as needed.  Decisions are
+                    recorded in the stats file.  Attachment IDs are set
+                    aside in blocks first (on MySQL, with ALTER TABLE
+                    attachments AUTO_INCREMENT), so users can go on
+                    adding attachments.
+  --max-lag=SECONDS With --throttle, stop writing while replicas are more
+                    than this far behind (default 10), or while their lag
+                    can't be measured; a minute of failed measurements
+                    stops the import.  Lag is measured by:
+  --lag-command=CMD A shell command printing the replica lag in seconds,
+  --replica-host=HOST[:PORT]
+                    or a MySQL replica to read Seconds_Behind_Master from.
+  --inject-latency=SECONDS[,PER_BUG]
+                    SQLite only: hold each transaction open this long, plus
+                    PER_BUG seconds per bug, to try --throttle out.
+  --writers=N       Write with N writers side by side, each with its own
+                    connection and transactions (default 1).  Bugs are
+                    split between them in ranges of bug numbers:
+  --shard-range=N   writer i gets bugs k*N to k*N+N-1 for each k where k
+                    modulo the number of writers is i (default 1000).
+  -j N, --jobs=N    Parse bug files in N processes; bugs are still written
+                    one at a time, in bug number order.
+  --read-ahead=N    Read the files of up to N bugs ahead of the parser
+                    (default 32).
+  --lazy-parse      Memory-map bug files instead of reading them ahead, and
+                    parse only headers up front: single-part messages are
+                    not split into parts, and attachments are decoded
+                    straight from the mapped file.
+  --parse-cache=DIR Keep parsed bugs in DIR, and reuse them in later runs
+                    for bugs whose files haven't changed since.
+  --parse-cache-size=BYTES
+                    Trim that cache to this size, least recently used
+                    first (default 1073741824).
+  --write-queue=N   Let up to N parsed bugs wait for the writer (default 64).
+  --spool-size=BYTES
+                    Keep decoded attachments up to this size in memory and
+                    spool larger ones to temporary files (default 1048576).
+  --memory-budget=BYTES
+                    Let the files read ahead of the parser, and the comment
+                    text and attachment data of parsed bugs waiting to be
+                    written, hold about this much memory between them.
+                    While that is used up, files are not read ahead (the
+                    parser reads them when it gets to them), and parsed
+                    bugs are kept on disk in the spool directory until
+                    written.  With --lazy-parse, description and comment
+                    text stays in the bug files and takes no memory until
+                    written; otherwise it is copied out when parsed, and
+                    only spilled once it doesn't fit.
+  --attachdir=DIR   Bugzilla's attachments directory.  Attachments larger
+                    than --max-attachment-size are written there, the way
+                    Bugzilla stores large attachments locally.  Without it,
+                    every attachment goes into attach_data in a single
+                    statement, so on MySQL none may be larger than the
+                    server's max_allowed_packet.
+  --max-attachment-size=KB
+                    Bugzilla's maxattachmentsize parameter (default 1000).
+  --journal=FILE    Record imported bugs in FILE.  Bugs already in the
+                    database are skipped; with a journal, those whose files
+                    changed since they were imported are imported again.
+  --verify          Don't import; check the bugs recorded in the journal
+                    against the database, which hashes their comments and
+                    attachments, and list those that are missing or
+                    differ from what was imported.
+  --verify-jobs=N   Check N ranges of bugs at once (default 4).
+  --dedup-attachments
+                    Store each distinct attachment only once.  Later
+                    copies in the same bug are left out, and copies in
+                    other bugs get a comment naming the stored attachment
+                    instead.  Hashes of stored attachments are kept across
+                    runs in the attachment index.
+  --duplicate-comments
+                    Also comment on copies within a bug.
+  --attachment-index=FILE
+                    That index (default jb2bz-attachments.idx).
+  --create-users    Create Bugzilla accounts for senders that don't have
+                    one; otherwise what they sent is attributed to the
+                    default reporter.
+  --defer-fulltext  Drop the full-text indexes on bugs_fulltext while
+                    importing and build them once at the end.  If a run
+                    is killed before then, the next run with this option
+                    builds them.
+  --bulk-load       For a first import into an empty or offline database:
+                    turn off foreign key and unique checks, drop the
+                    secondary indexes and foreign keys of the tables being
+                    loaded, load with LOAD DATA LOCAL INFILE where the
+                    server allows it, then rebuild and check it all.  A
+                    run that doesn't get that far leaves a state file,
+                    and the next run restores the schema from it first.
+  --bulk-state=FILE That state file (default jb2bz-bulk-state.json).
+  --export=FILE     Don't touch the database; write the bugs to FILE in the
+                    XML format read by importxml.pl, or as JSON lines.
+  --format=FORMAT   xml or jsonl (default: from FILE's extension, else xml).
+  --gzip            Compress the export (implied by a FILE ending in .gz).
+  --exporter=EMAIL  Login name used for the exported assignee, and for bugs,
+                    comments and attachments whose sender isn't known
+                    (default nobody@localhost).
+  --urlbase=URL     urlbase recorded in the XML export.
+  --stats-file=FILE Write a JSON summary of the run to FILE: counters,
+                    wall and CPU time per stage, and the slowest bugs.
+  --progress        Report progress, rate and ETA on stderr every second
+                    (every 30 seconds when stderr isn't a terminal).
+  --progress-interval=SECONDS
+                    Report progress every SECONDS instead.
+  --profile-bug=N   Parse bug N under cProfile and print the result.
+  --profile-file=FILE
+                    Where to save that profile (default jb2bz-N.prof).
+
+Product is the Product to assign these defects to.
+
+All of the JitterBugs in the current directory are imported, including replies, notes,
+attachments, and similar noise.
+"""
+    sys.exit(1)
+
+
+def main():
+    global bug_status, component, version, product
+    global db_driver, commit_every, commit_interval, jobs
+    global read_ahead, write_queue_size, lazy_parse
+    global parse_cache_path, parse_cache_size, parse_cache
+    global verify, verify_jobs
+    global attachment_spool_size, spool_dir, attachdir, max_attachment_size
+    global memory_budget, budget
+    global journal_path, export_path, export_format, export_gzip
+    global exporter, urlbase, stats_path, progress_interval
+    global profile_bug, profile_path, create_users, defer_fulltext
+    global bulk_load, bulk_state_path, tree_root, archive_path
+    global mail_path, first_bug, dedup_attachments, duplicate_comments
+    global throttle_target, max_replica_lag, lag_command, replica_host
+    global inject_latency, writers, shard_range
+    global attachment_index_path
+    opts, args = getopt.getopt(sys.argv[1:], "hs:c:v:j:",
+                               ["commit-every=", "commit-interval=",
+                                "throttle=", "max-lag=", "lag-command=",
+                                "replica-host=", "inject-latency=",
+                                "writers=", "shard-range=",
+                                "jobs=", "read-ahead=", "write-queue=",
+                                "lazy-parse", "parse-cache=",
+                                "parse-cache-size=",
+                                "spool-size=", "memory-budget=", "attachdir=",
+                                "max-attachment-size=", "journal=",
+                                "verify", "verify-jobs=",
+                                "dedup-attachments", "duplicate-comments",
+                                "attachment-index=",
+                                "create-users", "defer-fulltext",
+                                "bulk-load", "bulk-state=", "tree=",
+                                "archive=", "mbox=", "first-bug=",
+                                "export=", "format=", "gzip", "exporter=",
+                                "urlbase=", "db-driver=", "db-host=",
+                                "db-port=", "db-name=", "db-user=",
+                                "db-password=", "stats-file=", "progress",
+                                "progress-interval=", "profile-bug=",
+                                "profile-file="])
+
+    for o,a in opts:
+        if o == "-s":
+            if a in ('UNCONFIRMED','CONFIRMED','IN_PROGRESS','RESOLVED','VERIFIED'):
+                bug_status = a
+        elif o == '-c':
+            component = a
+        elif o == '-v':
+            version = a
+        elif o == '-h':
+            usage()
+        elif o == '--db-driver':
+            if a not in db_drivers:
+                sys.stderr.write("Unknown database driver: %s\n" % a)
+                sys.exit(1)
+            db_driver = a
+        elif o == '--db-host':
+            db_params['host'] = a
+        elif o == '--db-port':
+            db_params['port'] = int(a)
+        elif o == '--db-name':
+            db_params['db'] = a
+        elif o == '--db-user':
+            db_params['user'] = a
+        elif o == '--db-password':
+            db_params['passwd'] = a
+        elif o == '--commit-every':
+            commit_every = max(1, int(a))
+        elif o == '--commit-interval':
+            commit_interval = float(a)
+        elif o == '--writers':
+            writers = max(1, int(a))
+        elif o == '--shard-range':
+            shard_range = max(1, int(a))
+        elif o == '--throttle':
+            throttle_target = float(a)
+        elif o == '--max-lag':
+            max_replica_lag = float(a)
+        elif o == '--lag-command':
+            lag_command = a
+        elif o == '--replica-host':
+            replica_host = a
+        elif o == '--inject-latency':
+            inject_latency = map(float, (a + ",0").split(",")[:2])
+        elif o in ('-j', '--jobs'):
+            jobs = max(1, int(a))
+        elif o == '--read-ahead':
+            read_ahead = max(1, int(a))
+        elif o == '--lazy-parse':
+            lazy_parse = True
+        elif o == '--write-queue':
+            write_queue_size = max(1, int(a))
+        elif o == '--parse-cache':
+            parse_cache_path = a
+        elif o == '--parse-cache-size':
+            parse_cache_size = int(a)
+        elif o == '--spool-size':
+            attachment_spool_size = int(a)
+        elif o == '--memory-budget':
+            memory_budget = int(a)
+        elif o == '--attachdir':
+            attachdir = os.path.abspath(a)
+        elif o == '--max-attachment-size':
+            max_attachment_size = int(a)
+        elif o == '--journal':
+            journal_path = a
+        elif o == '--verify':
+            verify = True
+        elif o == '--verify-jobs':
+            verify_jobs = max(1, int(a))
+        elif o == '--dedup-attachments':
+            dedup_attachments = True
+        elif o == '--duplicate-comments':
+            duplicate_comments = True
+        elif o == '--attachment-index':
+            attachment_index_path = a
+        elif o == '--export':
+            export_path = a
+        elif o == '--format':
+            if a not in ('xml', 'jsonl'):
+                sys.stderr.write("Unknown export format: %s\n" % a)
+                sys.exit(1)
+            export_format = a
+        elif o == '--gzip':
+            export_gzip = True
+        elif o == '--exporter':
+            exporter = a
+        elif o == '--urlbase':
+            urlbase = a
+        elif o == '--stats-file':
+            stats_path = a
+        elif o == '--progress':
+            progress_interval = sys.stderr.isatty() and 1.0 or 30.0
+        elif o == '--progress-interval':
+            progress_interval = float(a)
+        elif o == '--create-users':
+            create_users = True
+        elif o == '--defer-fulltext':
+            defer_fulltext = True
+        elif o == '--tree':
+            tree_root = a
+        elif o == '--archive':
+            archive_path = a
+        elif o == '--mbox':
+            mail_path = a
+        elif o == '--first-bug':
+            first_bug = int(a)
+        elif o == '--bulk-load':
+            bulk_load = True
+        elif o == '--bulk-state':
+            bulk_state_path = a
+        elif o == '--profile-bug':
+            profile_bug = int(a)
+        elif o == '--profile-file':
+            profile_path = a
+
+    if tree_root is not None:
+        if args or archive_path is not None or mail_path is not None:
+            sys.stderr.write("--tree takes products from the directory names.\n")
+            sys.exit(1)
+        if os.path.isdir(tree_root):
+            directories = discover_tree(tree_root)
+            if not directories:
+                sys.stderr.write("No JitterBug directories in %s.\n" % tree_root)
+                sys.exit(1)
+        else:
+            archive_path = tree_root
+            settings_for = lambda d: tree_settings(posixpath.basename(d))
+            directories = []
+    elif len(args) != 1:
+        sys.stderr.write("Must specify the Product.\n")
+        sys.exit(1)
+    else:
+        product = args[0]
+        directories = [ (".", bug_settings()) ]
+        settings_for = lambda d: directories[0][1]
+
+    if verify:
+        if journal_path is None or export_path is not None:
+            sys.stderr.write("--verify needs a database and the journal of the import.\n")
+            sys.exit(1)
+        if db_driver == 'mysql' and MySQLdb is None:
+            sys.stderr.write("MySQLdb is required to verify an import into MySQL.\n")
+            sys.exit(1)
+        writer = db_drivers[db_driver](commit_every, commit_interval)
+        journal = Journal(journal_path)
+        try:
+            bad = verify_import(writer, journal)
+        finally:
+            journal.close()
+            writer.release()
+        sys.exit(bad and 2 or 0)
+
+    # Spooling next to the attachment store lets big attachments be
+    # hard-linked into place rather than copied.
+    spool_dir = tempfile.mkdtemp(prefix="jb2bz.", dir=attachdir)
+    if memory_budget is not None:
+        budget = MemoryBudget(memory_budget)
+    if parse_cache_path is not None:
+        parse_cache = ParseCache(parse_cache_path, parse_cache_size)
+    if mail_path is not None:
+        source = MailSource(mail_path, directories[0][1], first_bug,
+                            os.path.join(spool_dir, "messages.db"))
+    elif archive_path is not None:
+        source = ArchiveSource(archive_path, settings_for)
+    else:
+        source = DirectorySource(directories)
+    journal = None
+    if journal_path is not None:
+        journal = Journal(journal_path)
+    if writers > 1 and export_path is not None:
+        sys.stderr.write("--writers needs a database to import into.\n")
+        sys.exit(1)
+    if dedup_attachments and export_path is not None:
+        sys.stderr.write("--dedup-attachments needs a database to import into.\n")
+        sys.exit(1)
+    if export_path is not None:
+        name = export_path
+        if name.endswith(".gz"):
+            name = name[:-3]
+            export_gzip = True
+        if export_format is None:
+            export_format = name.endswith((".jsonl", ".json")) and 'jsonl' or 'xml'
+        if export_format == 'jsonl':
+            writer = JSONExporter(export_path, export_gzip)
+        else:
+            writer = XMLExporter(export_path, export_gzip)
+        writer.journal = journal
+    elif db_driver == 'mysql' and MySQLdb is None:
+        sys.stderr.write("MySQLdb is required to import into MySQL.\n")
+        sys.exit(1)
+    elif writers > 1:
+        writer = ShardedWriter(db_drivers[db_driver], writers, journal)
+    else:
+        writer = db_drivers[db_driver](commit_every, commit_interval, journal)
+    if export_path is None:
+        if dedup_attachments:
+            writer.attachment_index = AttachmentIndex(attachment_index_path)
+        if throttle_target is not None:
+            if replica_host is not None and MySQLdb is None:
+                sys.stderr.write("MySQLdb is required to read replica lag.\n")
+                sys.exit(1)
+            # Each writer paces itself, with a probe of its own.
+            for w in isinstance(writer, ShardedWriter) and writer.shards or [ writer ]:
+                probe = None
+                if lag_command is not None:
+                    probe = CommandLagProbe(lag_command)
+                elif replica_host is not None:
+                    probe = MySQLReplicaLagProbe(replica_host)
+                w.throttle = Throttle(throttle_target, commit_every, probe,
+                                      max_replica_lag)
+    stats = Stats()
+    try:
+        try:
+            try:
+                try:
+                    writer.load_lookups(sorted(set(source.names())))
+                except LookupError, e:
+                    sys.stderr.write("%s\n" % e)
+                    sys.exit(1)
+                writer.prepare()
+                bugs = source.bugs(writer.existing_bug_ids(), journal, stats)
+                try:
+                    run_pipeline(bugs, writer, stats)
+                except LookupError, e:
+                    sys.stderr.write("%s\n" % e)
+                    sys.exit(1)
+            finally:
+                with timed(stats.stages, 'write'):
+                    writer.close()
+                if journal is not None:
+                    journal.close()
+                if dedup_attachments and export_path is None:
+                    writer.attachment_index.close()
+        finally:
+            shutil.rmtree(spool_dir, True)
+            if parse_cache is not None:
+                parse_cache.evict()
+    finally:
+        stats.progress(done=True)
+        if stats_path is not None:
+            f = open(stats_path, "w")
+            json.dump(stats.summary(writer), f, indent=2, sort_keys=True)
+            f.close()
 
-    for bug in filter(lambda x: re.match(r"\d+$", x), glob.glob("*")):
-        process_jitterbug(bug)
-        
+    if writer.failed:
+        sys.stderr.write("%d bugs could not be imported: %s\n"
+                         % (len(writer.failed), " ".join(map(str, writer.failed))))
+        sys.exit(2)
 
 if __name__ == "__main__":
     main()